@@ -2,13 +2,77 @@
 #[Initialize]===========================================================================================================
 # Import the necessary modules
 
-from flask import Flask, render_template, url_for, redirect, Response, send_from_directory
+from flask import Flask, render_template, stream_template, url_for, redirect, Response, request, abort, jsonify, send_file, before_render_template, g
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file, ClosingIterator
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from markupsafe import Markup, escape
+from urllib.parse import quote, unquote, urlsplit, urljoin
+from html.parser import HTMLParser
+from jinja2 import pass_context
+import urllib.request
+import click
 from flask_flatpages import FlatPages
+from flask_flatpages.utils import pygmented_markdown
+from functools import cached_property, wraps
+from collections import namedtuple, OrderedDict, Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import markdown
-from datetime import datetime
+from markdown.extensions.codehilite import CodeHilite
+import yaml
+from datetime import datetime, date, timezone
+import threading
+import atexit
+import base64
+import bisect
+import heapq
+import mmap
+import re
+import struct
+import math
+import sqlite3
+import hashlib
+import zlib
+import json
+import gzip
+import mimetypes
+import shutil
 import time
 import os
 
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+try:
+	from pypdf import PdfReader
+except ImportError:
+	PdfReader = None
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+try:
+	from PIL import Image, ImageOps
+except ImportError:
+	Image = None
+
+try:
+	from fontTools import subset as font_subset
+except ImportError:
+	font_subset = None
+
+try:
+	from watchdog.observers import Observer
+	from watchdog.events import FileSystemEventHandler
+except ImportError:
+	Observer = None
+
 #[Configuration]========================================================================================================
 # Configure the app settings
 
@@ -25,6 +89,2023 @@ app.config['FLATPAGES_MARKDOWN_EXTENSION_CONFIGS'] = {
 }
 
 pages = FlatPages(app)
+pagesdir = os.path.join(app.root_path, app.config['FLATPAGES_ROOT'])
+
+# Seconds between checks of pages/ for new or modified posts
+app.config['POSTS_REFRESH_INTERVAL'] = float(os.environ.get("POSTS_REFRESH_INTERVAL", 2))
+# Seconds between checks of static/documents for added, removed or overwritten files when not watching
+app.config['DOCUMENTS_REFRESH_INTERVAL'] = float(os.environ.get("DOCUMENTS_REFRESH_INTERVAL", 2))
+# Documents per page in /dochub/api/documents
+app.config['DOCUMENTS_PER_PAGE'] = int(os.environ.get("DOCUMENTS_PER_PAGE", 24))
+# Sidecar database with the extracted metadata of every document, reused across restarts
+app.config['DOCUMENT_INDEX_FILE'] = os.environ.get("DOCUMENT_INDEX_FILE", os.path.join(app.instance_path, 'documents.sqlite3'))
+# Seconds browsers and proxies may keep a downloaded document before revalidating
+app.config['DOCUMENT_MAX_AGE'] = int(os.environ.get("DOCUMENT_MAX_AGE", 7 * 24 * 3600))
+# Same for /dochub/blob/<hash>/<name>, whose content can never change
+app.config['DOCUMENT_BLOB_MAX_AGE'] = int(os.environ.get("DOCUMENT_BLOB_MAX_AGE", 365 * 24 * 3600))
+# Response header marking a body that is only a manifest of file ranges for the front end to send, set by asgi.py
+app.config['DOCUMENT_OFFLOAD_HEADER'] = None
+# Response header with the download slot the front end frees once it has sent such a body, set by asgi.py
+app.config['DOCUMENT_RELEASE_HEADER'] = None
+# Full text index of the documents, and the cached page texts it is rebuilt from, keyed by content hash
+app.config['DOCUMENT_SEARCH_FILE'] = os.environ.get("DOCUMENT_SEARCH_FILE", os.path.join(app.instance_path, 'documents.idx'))
+app.config['DOCUMENT_TEXT_DIR'] = os.environ.get("DOCUMENT_TEXT_DIR", os.path.join(app.instance_path, 'documents-text'))
+# Number of reverse proxies in front of the app, their X-Forwarded-For entries identify the client
+app.config['TRUSTED_PROXIES'] = int(os.environ.get("TRUSTED_PROXIES", 0))
+# Per client download limits: sustained bytes per second, burst bytes and simultaneous downloads. Off by default unless
+# the proxies are configured, behind an unconfigured proxy every visitor would share one client's limits
+app.config['DOWNLOAD_LIMITS'] = os.environ.get("DOWNLOAD_LIMITS", "1" if app.config['TRUSTED_PROXIES'] else "0") == "1"
+app.config['DOWNLOAD_RATE'] = int(os.environ.get("DOWNLOAD_RATE", 1 << 20))
+app.config['DOWNLOAD_BURST'] = int(os.environ.get("DOWNLOAD_BURST", 32 << 20))
+app.config['DOWNLOAD_CONCURRENCY'] = int(os.environ.get("DOWNLOAD_CONCURRENCY", 4))
+app.config['DOWNLOAD_LIMITS_FILE'] = os.environ.get("DOWNLOAD_LIMITS_FILE", os.path.join(app.instance_path, 'limits.sqlite3'))
+# Seconds browsers may cache static files requested under their fingerprinted names
+app.config['STATIC_MAX_AGE'] = int(os.environ.get("STATIC_MAX_AGE", 365 * 24 * 3600))
+# Static image directories that get resized webp/avif variants from flask build-images, and the widths to make
+app.config['IMAGE_DIRS'] = os.environ.get("IMAGE_DIRS", "img,rabridx133").split(',')
+app.config['IMAGE_WIDTHS'] = [int(width) for width in os.environ.get("IMAGE_WIDTHS", "320,640,960,1280,1920").split(',')]
+# Download and page view counts, aggregated per worker and written every COUNTERS_FLUSH_INTERVAL seconds
+app.config['COUNTERS'] = os.environ.get("COUNTERS", "1") == "1"
+app.config['COUNTERS_FILE'] = os.environ.get("COUNTERS_FILE", os.path.join(app.instance_path, 'counters.sqlite3'))
+app.config['COUNTERS_FLUSH_INTERVAL'] = float(os.environ.get("COUNTERS_FLUSH_INTERVAL", 5))
+# Inline the above the fold rules of cryo.css written by flask critical-css, and load the whole file without blocking
+app.config['CRITICAL_CSS'] = os.environ.get("CRITICAL_CSS", "1") == "1"
+# Refresh indexes from inotify events instead of polling, needs watchdog
+app.config['WATCH_FILES'] = os.environ.get("WATCH_FILES", "1") == "1"
+# Posts per page on the home page and in /api/posts
+app.config['POSTS_PER_PAGE'] = int(os.environ.get("POSTS_PER_PAGE", 10))
+
+
+# Search index file, memory mapped by every worker
+app.config['SEARCH_INDEX_FILE'] = os.environ.get("SEARCH_INDEX_FILE", os.path.join(app.instance_path, 'search.idx'))
+# Number of changed posts kept in memory before the search index file is rewritten
+app.config['SEARCH_DELTA_LIMIT'] = int(os.environ.get("SEARCH_DELTA_LIMIT", 64))
+
+# Highlighted code blocks kept in memory, and optionally on disk across restarts
+app.config['HIGHLIGHT_CACHE_SIZE'] = int(os.environ.get("HIGHLIGHT_CACHE_SIZE", 1024))
+app.config['HIGHLIGHT_CACHE_DIR'] = os.environ.get("HIGHLIGHT_CACHE_DIR")
+
+if app.config['TRUSTED_PROXIES']:
+	app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
+
+#[Highlight Cache]======================================================================================================
+# Cache the html of every highlighted code block, keyed by its source, lexer and formatter options
+
+class HighlightCache:
+	def __init__(self, size, directory=None):
+		self.size = size
+		self.directory = directory
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+
+	def key(self, block, shebang):
+		formatter = block.pygments_formatter
+		if not isinstance(formatter, str):
+			formatter = f"{formatter.__module__}.{formatter.__qualname__}"
+		options = json.dumps([block.src, block.lang, block.lang_prefix, block.guess_lang, block.use_pygments, formatter, shebang, block.options], sort_keys=True, default=repr)
+		return hashlib.sha256(options.encode()).hexdigest()
+
+	def get(self, key):
+		with self.lock:
+			html = self.entries.get(key)
+			if html is not None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return html
+		if self.directory:
+			try:
+				with open(os.path.join(self.directory, key + '.html'), encoding='utf-8') as handler:
+					html = handler.read()
+			except FileNotFoundError:
+				pass
+			else:
+				self.disk_hits += 1
+				self.put(key, html, persist=False)
+				return html
+		self.misses += 1
+		return None
+
+	def put(self, key, html, persist=True):
+		with self.lock:
+			self.entries[key] = html
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+		if persist and self.directory:
+			# write then rename so other workers never read a partial file
+			filename = os.path.join(self.directory, key + '.html')
+			with open(f"{filename}.{os.getpid()}.tmp", 'w', encoding='utf-8') as handler:
+				handler.write(html)
+			os.replace(f"{filename}.{os.getpid()}.tmp", filename)
+
+	def stats(self):
+		return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'entries': len(self.entries), 'size': self.size}
+
+highlight_cache = HighlightCache(app.config['HIGHLIGHT_CACHE_SIZE'], app.config['HIGHLIGHT_CACHE_DIR'])
+
+# codehilite and fenced_code both highlight through CodeHilite.hilite
+uncached_hilite = CodeHilite.hilite
+
+def cached_hilite(self, shebang=True):
+	key = highlight_cache.key(self, shebang)
+	html = highlight_cache.get(key)
+	if html is None:
+		html = uncached_hilite(self, shebang)
+		highlight_cache.put(key, html)
+	return html
+
+CodeHilite.hilite = cached_hilite
+
+
+#[Post Index]===========================================================================================================
+# Keep a sorted list of lightweight post records, reparsing only the files whose mtime changed.
+# Only the yaml front matter is read for the index, post bodies are loaded when a page is rendered
+
+Post = namedtuple('Post', ['path', 'title', 'date', 'summary', 'readtime', 'author'])
+
+def post_key(post):
+	return (str(post.date or ''), post.path)
+
+def post_json(post):
+	return dict(post._asdict(), date=str(post.date) if post.date else None, url=url_for('idea_page', path=post.path))
+
+def encode_cursor(key):
+	return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+	try:
+		key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+	except ValueError:
+		return None
+	if not (isinstance(key, list) and len(key) == 2 and all(isinstance(part, str) for part in key)):
+		return None
+	return tuple(key)
+
+def read_header(handler):
+	# read the front matter up to the closing --- (or the first blank line without one), returns (meta, body offset)
+	lines = []
+	line = handler.readline()
+	fenced = line.strip() == b'---'
+	if fenced:
+		line = handler.readline()
+		while line and line.strip() not in (b'---', b'...'):
+			lines.append(line)
+			line = handler.readline()
+	else:
+		while line.strip():
+			lines.append(line)
+			line = handler.readline()
+	offset = handler.tell()
+	meta = {}
+	try:
+		for doc in yaml.safe_load_all(b''.join(lines)):
+			if isinstance(doc, dict):
+				meta.update(doc)
+	except yaml.YAMLError:
+		meta = {}
+	if not meta and not fenced:
+		# a plain paragraph, not front matter
+		return {}, 0
+	return meta, offset
+
+class LazyPage:
+	# stands in for a flatpages Page, the body is only mapped and read when it is rendered
+	def __init__(self, path, filename):
+		self.path = path
+		self.filename = filename
+
+	def __getitem__(self, name):
+		return self.meta[name]
+
+	def __html__(self):
+		return self.html
+
+	@cached_property
+	def meta(self):
+		with open(self.filename, 'rb') as handler:
+			return read_header(handler)[0]
+
+	@cached_property
+	def body(self):
+		if os.path.getsize(self.filename) == 0:
+			return ''
+		with open(self.filename, 'rb') as handler, mmap.mmap(handler.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			offset = read_header(data)[1]
+			return data[offset:].decode('utf-8').lstrip('\n')
+
+	@cached_property
+	def html(self):
+		return pygmented_markdown(self.body, pages)
+
+class PostIndex:
+	def __init__(self, root, extension, interval):
+		self.root = root
+		self.extension = extension
+		self.interval = interval
+		self.entries = {} # path -> (mtime, Post)
+		self.listing = ([], []) # posts newest first, and their keys oldest first for bisecting cursors
+		self.version = 0 # bumped on every change, lets dependent indexes skip unchanged refreshes
+		self.checked = 0
+		self.lock = threading.Lock()
+
+	@property
+	def posts(self):
+		return self.listing[0]
+
+	def get(self):
+		if time.monotonic() - self.checked >= self.interval:
+			self.refresh()
+		return self.posts
+
+	def page(self, cursor=None, limit=10):
+		# cursor is the key of the last post already shown, the page starts right after it
+		self.get()
+		posts, keys = self.listing
+		start = 0
+		if cursor is not None:
+			start = len(keys) - bisect.bisect_left(keys, cursor)
+		chunk = posts[start:start + limit]
+		next_cursor = None
+		if start + limit < len(posts):
+			next_cursor = encode_cursor(post_key(chunk[-1]))
+		return chunk, next_cursor
+
+	def filename(self, path):
+		return os.path.join(self.root, path + self.extension)
+
+	def page_for(self, path):
+		return LazyPage(path, self.filename(path))
+
+	def load(self, path, filename):
+		with open(filename, 'rb') as handler:
+			meta, _ = read_header(handler)
+		return Post(path, meta.get('title'), meta.get('date'), meta.get('summary'), meta.get('readtime'), meta.get('author'))
+
+	def refresh(self):
+		with self.lock:
+			entries = {}
+			changed = False
+			for cur_path, _, filenames in os.walk(self.root):
+				for name in filenames:
+					if not name.endswith(self.extension):
+						continue
+					filename = os.path.join(cur_path, name)
+					path = os.path.relpath(filename, self.root)[:-len(self.extension)].replace(os.sep, '/')
+					mtime = os.stat(filename).st_mtime_ns
+					entry = self.entries.get(path)
+					if entry is None or entry[0] != mtime:
+						entry = (mtime, self.load(path, filename))
+						changed = True
+					entries[path] = entry
+			if changed or len(entries) != len(self.entries):
+				posts = sorted((post for _, post in entries.values()), key=post_key)
+				# readers always see a matching listing, the watcher thread swaps it in one assignment
+				self.listing = (posts[::-1], [post_key(post) for post in posts])
+				self.entries = entries
+				self.version += 1
+			self.checked = time.monotonic()
+
+post_index = PostIndex(pagesdir, app.config['FLATPAGES_EXTENSION'], app.config['POSTS_REFRESH_INTERVAL'])
+post_index.refresh()
+
+
+#[Page Cache]===========================================================================================================
+# Cache the rendered html of each post, keyed by the hash of its source, the markdown configuration and the static
+# assets the page links to
+
+def page_fingerprint():
+	digest = hashlib.sha256()
+	digest.update(json.dumps([app.config['FLATPAGES_MARKDOWN_EXTENSIONS'], app.config['FLATPAGES_MARKDOWN_EXTENSION_CONFIGS']], sort_keys=True, default=str).encode())
+	with open(os.path.join(app.root_path, app.template_folder, 'page.html'), 'rb') as handler:
+		digest.update(handler.read())
+	# pages embed fingerprinted urls and inlined css, a changed asset has to change their etag too
+	digest.update(json.dumps([asset_manifest.hashed, critical_manifest], sort_keys=True).encode())
+	return digest.digest()
+
+class PageCache:
+	def __init__(self, index, fingerprinter):
+		self.index = index
+		self.fingerprinter = fingerprinter
+		self.entries = {} # path -> (mtime, etag, html)
+
+	@cached_property
+	def fingerprint(self):
+		# on first use, the asset manifests are built further down
+		return self.fingerprinter()
+
+	def lookup(self, path):
+		# polls the directory on its interval when no watcher keeps the index fresh
+		self.index.get()
+		entry = self.index.entries.get(path)
+		if entry is None:
+			return None
+		mtime = entry[0]
+		cached = self.entries.get(path)
+		if cached is not None and cached[0] == mtime:
+			return cached
+		with open(self.index.filename(path), 'rb') as handler:
+			etag = hashlib.sha256(self.fingerprint + handler.read()).hexdigest()
+		if cached is not None and cached[1] == etag:
+			cached = (mtime, etag, cached[2])
+		else:
+			cached = (mtime, etag, None)
+		self.entries[path] = cached
+		return cached
+
+	def render(self, path, renderer):
+		mtime, etag, html = self.lookup(path)
+		if html is None:
+			html = renderer()
+			self.entries[path] = (mtime, etag, html)
+		return html
+
+page_cache = PageCache(post_index, page_fingerprint)
+
+def conditional_response(etag, last_modified, render, mimetype='text/html'):
+	# answer with 304 when the client already has this version, render() is only called otherwise
+	if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+		response = Response(render(), mimetype=mimetype)
+	else:
+		response = Response(status=304)
+	response.set_etag(etag)
+	response.last_modified = last_modified
+	return response
+
+
+#[Feeds]================================================================================================================
+# Atom feed and sitemap built from the post index, rebuilt only when a post is added, changed or removed
+
+# Endpoints left out of the sitemap, they redirect or are not pages
+sitemap_excluded = {'static', 'redirect_to_home', 'search', 'posts_api', 'search_api', 'highlight_stats', 'feed', 'sitemap', 'documents_api', 'document_search_page', 'document_search_api', 'document_blob', 'document_bundle'}
+
+IndexedBody = namedtuple('IndexedBody', ['body', 'etag', 'last_modified'])
+
+class IndexedDocument:
+	# the urls in it are absolute, so there is one rendering per host the site is reached under
+	def __init__(self, index, template, hosts=8):
+		self.index = index
+		self.template = template
+		self.hosts = hosts
+		self.version = None
+		self.rendered = OrderedDict() # request.host_url -> IndexedBody, for self.version
+
+	def get(self):
+		self.index.get()
+		version, host = self.index.version, request.host_url
+		if self.version != version:
+			self.rendered, self.version = OrderedDict(), version
+		rendered = self.rendered.get(host)
+		if rendered is None:
+			entries = self.index.entries
+			updated = max((mtime for mtime, _ in entries.values()), default=time.time_ns())
+			last_modified = datetime.fromtimestamp(updated / 1e9, timezone.utc).replace(microsecond=0)
+			body = render_template(self.template, posts=self.index.posts, updated=last_modified, mtimes={path: datetime.fromtimestamp(mtime / 1e9, timezone.utc).replace(microsecond=0) for path, (mtime, _) in entries.items()}, pages=sitemap_urls()).encode()
+			rendered = IndexedBody(body, hashlib.sha256(body).hexdigest(), last_modified)
+			self.rendered[host] = rendered
+			# the host header is up to the client, keep only the last few
+			while len(self.rendered) > self.hosts:
+				self.rendered.popitem(last=False)
+		return rendered
+
+def sitemap_urls():
+	return [url_for(rule.endpoint, _external=True) for rule in app.url_map.iter_rules() if rule.endpoint not in sitemap_excluded and 'GET' in rule.methods and not rule.arguments]
+
+@app.template_filter('atom_datetime')
+def atom_datetime(value):
+	# front matter dates come as dates, datetimes or text, None when it is none of those
+	if isinstance(value, str):
+		try:
+			value = datetime.fromisoformat(value)
+		except ValueError:
+			return None
+	if isinstance(value, datetime):
+		return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).isoformat()
+	if isinstance(value, date):
+		return f"{value.isoformat()}T00:00:00Z"
+	return None
+
+feed_document = IndexedDocument(post_index, 'feed.xml')
+sitemap_document = IndexedDocument(post_index, 'sitemap.xml')
+
+
+#[Search]===============================================================================================================
+# BM25 ranked full text search over the posts, read from a memory mapped index file plus an in-memory
+# delta holding the posts changed since the file was written
+
+word_pattern = re.compile(r'\w+')
+field_weights = (('title', 3), ('summary', 2), ('body', 1))
+
+def tokenize(text):
+	return word_pattern.findall(text.lower())
+
+def inverse_frequency(count, df):
+	return math.log(1 + (count - df + 0.5) / (df + 0.5))
+
+def bm25(idf, tf, length, avgdl, k1=1.2, b=0.75):
+	return idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avgdl))
+
+def pad4(length):
+	return length + (-length % 4)
+
+class SearchSegment:
+	# header | docs json | term offsets | terms | posting offsets | postings as (doc id, tf) pairs
+	header = struct.Struct('<4sIIII')
+	magic = b'RSX1'
+
+	def __init__(self, filename):
+		with open(filename, 'rb') as handler:
+			self.data = mmap.mmap(handler.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, n_docs, n_terms, docs_len, terms_len = self.header.unpack_from(self.data)
+		if magic != self.magic:
+			raise ValueError(f"{filename} is not a search index")
+		view = memoryview(self.data)
+		offset = self.header.size
+		self.docs = json.loads(bytes(view[offset:offset + docs_len])) # [path, mtime, length] per doc id
+		offset += pad4(docs_len)
+		self.term_offsets = view[offset:offset + 4 * (n_terms + 1)].cast('I')
+		offset += 4 * (n_terms + 1)
+		self.terms = view[offset:offset + terms_len]
+		offset += pad4(terms_len)
+		self.posting_offsets = view[offset:offset + 4 * (n_terms + 1)].cast('I')
+		offset += 4 * (n_terms + 1)
+		self.postings = self.read_postings(view[offset:])
+		self.n_terms = n_terms
+
+	def read_postings(self, view):
+		return view.cast('I')
+
+	def term(self, i):
+		return bytes(self.terms[self.term_offsets[i]:self.term_offsets[i + 1]])
+
+	def find(self, term, prefix=False):
+		key = term.encode()
+		ids = range(self.n_terms)
+		lo = bisect.bisect_left(ids, key, key=self.term)
+		if prefix:
+			# 0xff never occurs in utf-8, so this is the end of every term starting with key
+			return range(lo, bisect.bisect_left(ids, key + b'\xff', lo, key=self.term))
+		if lo < self.n_terms and self.term(lo) == key:
+			return range(lo, lo + 1)
+		return range(0)
+
+	def postings_for(self, i):
+		postings = self.postings[2 * self.posting_offsets[i]:2 * self.posting_offsets[i + 1]]
+		return zip(postings[::2], postings[1::2])
+
+	@classmethod
+	def write(cls, filename, docs, postings):
+		terms = sorted(postings)
+		blob = b''.join(term.encode() for term in terms)
+		docs_json = json.dumps(docs).encode()
+		term_offsets = [0]
+		for term in terms:
+			term_offsets.append(term_offsets[-1] + len(term.encode()))
+		posting_offsets, posting_data = cls.encode_postings(terms, postings)
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		tmpname = f"{filename}.{os.getpid()}.tmp"
+		with open(tmpname, 'wb') as handler:
+			handler.write(cls.header.pack(cls.magic, len(docs), len(terms), len(docs_json), len(blob)))
+			handler.write(docs_json.ljust(pad4(len(docs_json)), b' '))
+			handler.write(struct.pack(f'={len(term_offsets)}I', *term_offsets))
+			handler.write(blob.ljust(pad4(len(blob)), b'\0'))
+			handler.write(struct.pack(f'={len(posting_offsets)}I', *posting_offsets))
+			handler.write(posting_data)
+		os.replace(tmpname, filename)
+
+	@classmethod
+	def encode_postings(cls, terms, postings):
+		offsets, flat = [0], []
+		for term in terms:
+			for doc_id, tf in postings[term]:
+				flat += (doc_id, tf)
+			offsets.append(len(flat) // 2)
+		return offsets, struct.pack(f'={len(flat)}I', *flat)
+
+def encode_varints(numbers):
+	data = bytearray()
+	for number in numbers:
+		while number >= 0x80:
+			data.append(number & 0x7f | 0x80)
+			number >>= 7
+		data.append(number)
+	return data
+
+def decode_varints(data):
+	number = shift = 0
+	for byte in data:
+		number |= (byte & 0x7f) << shift
+		if byte & 0x80:
+			shift += 7
+		else:
+			yield number
+			number = shift = 0
+
+class CompressedSegment(SearchSegment):
+	# same layout, but postings are varint encoded doc id gaps and tfs, and posting offsets count bytes
+	magic = b'RSZ1'
+
+	def read_postings(self, view):
+		return view
+
+	def postings_for(self, i):
+		numbers = decode_varints(self.postings[self.posting_offsets[i]:self.posting_offsets[i + 1]])
+		doc_id = 0
+		for gap, tf in zip(numbers, numbers):
+			doc_id += gap
+			yield doc_id, tf
+
+	@classmethod
+	def encode_postings(cls, terms, postings):
+		offsets, data = [0], bytearray()
+		for term in terms:
+			previous = 0
+			for doc_id, tf in postings[term]:
+				data += encode_varints((doc_id - previous, tf))
+				previous = doc_id
+			offsets.append(len(data))
+		return offsets, bytes(data)
+
+class SearchIndex:
+	def __init__(self, filename, index, delta_limit):
+		self.filename = filename
+		self.index = index
+		self.delta_limit = delta_limit
+		self.segment = None
+		self.live = {} # path -> mtime of every searchable post
+		self.segment_ids = {} # path -> doc id, for live posts stored in the segment
+		self.deleted = set() # segment doc ids replaced by the delta or removed
+		self.delta = {} # path -> length, for posts newer than the segment
+		self.delta_terms = defaultdict(dict) # term -> {path: tf}
+		self.total_length = 0
+		self.version = None
+		self.lock = threading.Lock()
+
+	def open(self):
+		try:
+			segment = SearchSegment(self.filename)
+		except (FileNotFoundError, ValueError, struct.error):
+			segment = None
+		self.segment = segment
+		self.live, self.segment_ids, self.deleted = {}, {}, set()
+		self.delta, self.delta_terms = {}, defaultdict(dict)
+		self.total_length = 0
+		self.version = None
+		if segment is not None:
+			for doc_id, (path, mtime, length) in enumerate(segment.docs):
+				self.live[path] = mtime
+				self.segment_ids[path] = doc_id
+				self.total_length += length
+
+	def remove(self, path):
+		if path in self.segment_ids:
+			doc_id = self.segment_ids.pop(path)
+			self.deleted.add(doc_id)
+			self.total_length -= self.segment.docs[doc_id][2]
+		if path in self.delta:
+			self.total_length -= self.delta.pop(path)
+			for term in list(self.delta_terms):
+				docs = self.delta_terms[term]
+				if docs.pop(path, None) is not None and not docs:
+					del self.delta_terms[term]
+		self.live.pop(path, None)
+
+	def add(self, path, mtime, post):
+		self.remove(path)
+		fields = {'title': str(post.title or ''), 'summary': str(post.summary or ''), 'body': self.index.page_for(path).body}
+		tf = Counter()
+		for field, weight in field_weights:
+			for term in tokenize(fields[field]):
+				tf[term] += weight
+		length = sum(tf.values())
+		for term, count in tf.items():
+			self.delta_terms[term][path] = count
+		self.delta[path] = length
+		self.live[path] = mtime
+		self.total_length += length
+
+	def sync(self):
+		# bring the index in line with the post index, tokenizing only new or modified posts
+		self.index.get()
+		if self.version == self.index.version:
+			return
+		with self.lock:
+			version = self.index.version
+			entries = self.index.entries
+			for path, (mtime, post) in entries.items():
+				if self.live.get(path) != mtime:
+					self.add(path, mtime, post)
+			for path in [path for path in self.live if path not in entries]:
+				self.remove(path)
+			self.version = version
+			if self.segment is None or len(self.delta) > self.delta_limit:
+				self.compact()
+
+	def compact(self):
+		# rewrite the file with the live segment postings and the delta, then map it again
+		docs, ids = [], {}
+		for path, mtime in self.live.items():
+			ids[path] = len(docs)
+			length = self.delta[path] if path in self.delta else self.segment.docs[self.segment_ids[path]][2]
+			docs.append([path, mtime, length])
+		postings = defaultdict(list)
+		if self.segment is not None:
+			remap = {doc_id: ids[path] for path, doc_id in self.segment_ids.items()}
+			for i in range(self.segment.n_terms):
+				matches = [(remap[doc_id], tf) for doc_id, tf in self.segment.postings_for(i) if doc_id in remap]
+				if matches:
+					postings[self.segment.term(i).decode()] = matches
+		for term, matches in self.delta_terms.items():
+			postings[term].extend((ids[path], tf) for path, tf in matches.items())
+		for matches in postings.values():
+			matches.sort()
+		SearchSegment.write(self.filename, docs, postings)
+		version = self.version
+		self.open()
+		self.version = version
+
+	def matches(self, term, prefix):
+		# yields one {path: tf} dict per indexed term matching the query term
+		if self.segment is not None:
+			for i in self.segment.find(term, prefix)[:50]:
+				docs = {self.segment.docs[doc_id][0]: tf for doc_id, tf in self.segment.postings_for(i) if doc_id not in self.deleted}
+				if docs:
+					yield docs
+		if prefix:
+			for indexed in [indexed for indexed in self.delta_terms if indexed.startswith(term)][:50]:
+				yield self.delta_terms[indexed]
+		elif term in self.delta_terms:
+			yield self.delta_terms[term]
+
+	def search(self, query, limit=20):
+		self.sync()
+		terms = tokenize(query)
+		with self.lock:
+			if not terms or not self.live:
+				return []
+			count = len(self.live)
+			avgdl = self.total_length / count or 1
+			scores = defaultdict(float)
+			for position, term in enumerate(terms):
+				# the last word is still being typed, so it also matches as a prefix
+				for docs in self.matches(term, prefix=position == len(terms) - 1):
+					idf = inverse_frequency(count, len(docs))
+					for path, tf in docs.items():
+						length = self.delta[path] if path in self.delta else self.segment.docs[self.segment_ids[path]][2]
+						scores[path] += bm25(idf, tf, length, avgdl)
+			ranked = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+		entries = self.index.entries
+		return [entries[path][1] for path, _ in ranked if path in entries]
+
+search_index = SearchIndex(app.config['SEARCH_INDEX_FILE'], post_index, app.config['SEARCH_DELTA_LIMIT'])
+search_index.open()
+search_index.sync()
+
+
+#[Document Catalog]=====================================================================================================
+# Every file in static/documents with its bracket tags parsed once, rebuilt when the directory changes
+
+Document = namedtuple('Document', ['filename', 'title', 'tags', 'size', 'mtime'])
+
+tag_pattern = re.compile(r'\[([^\[\]]+)\]')
+
+class DocumentCatalog:
+	def __init__(self, directory, interval):
+		self.directory = directory
+		self.interval = interval
+		self.watched = False # the watcher refreshes the catalog, skip polling on requests
+		self.checked = 0
+		self.documents = [] # sorted by filename
+		self.tags = {} # tag -> set of filenames
+		self.by_filename = {} # filename -> Document
+		self.tag_counts = {} # tag -> number of documents
+		self.pair_counts = {} # (tag, tag) in sorted order -> number of documents having both
+		self.queries = {} # tags -> filenames having all of them, filled on demand
+		self.digests = {} # filename -> ((size, mtime), sha256), kept across refreshes
+		self.info = {} # filename -> extracted metadata, filled by the document indexer
+		self.blobs = defaultdict(set) # sha256 -> filenames with that content, from the digests already known
+		self.checksums = {} # sha256 -> crc32 for zip bundles, filled by the document indexer
+		self.listeners = [] # called after every refresh
+		self.lock = threading.Lock()
+
+	def get(self):
+		# overwriting a file in place leaves the directory mtime alone, so every file's size and mtime is compared
+		if not self.watched and time.monotonic() - self.checked >= self.interval:
+			if self.scan() != [(document.filename, document.size, document.mtime) for document in self.documents]:
+				self.refresh()
+			self.checked = time.monotonic()
+		return self
+
+	def scan(self):
+		with os.scandir(self.directory) as entries:
+			return sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in entries if entry.is_file())
+
+	def refresh(self):
+		with self.lock:
+			documents = []
+			tags = defaultdict(set)
+			pair_counts = Counter()
+			with os.scandir(self.directory) as entries:
+				for entry in entries:
+					if not entry.is_file():
+						continue
+					stat = entry.stat()
+					name_tags = tuple(tag_pattern.findall(entry.name))
+					title = tag_pattern.sub('', os.path.splitext(entry.name)[0]).strip()
+					documents.append(Document(entry.name, title, name_tags, stat.st_size, stat.st_mtime_ns))
+					for tag in name_tags:
+						tags[tag].add(entry.name)
+					unique = sorted(set(name_tags))
+					for i, first in enumerate(unique):
+						for second in unique[i + 1:]:
+							pair_counts[first, second] += 1
+			documents.sort()
+			self.documents, self.tags, self.queries = documents, dict(tags), {}
+			self.by_filename = {document.filename: document for document in documents}
+			self.tag_counts = {tag: len(filenames) for tag, filenames in tags.items()}
+			self.pair_counts = dict(pair_counts)
+			self.checked = time.monotonic()
+		for listener in self.listeners:
+			listener()
+
+	def filenames(self, *tags):
+		# filenames carrying every one of the tags, in filename order
+		self.get()
+		key = tuple(sorted(tags))
+		result = self.queries.get(key)
+		if result is None:
+			if key:
+				matches = set.intersection(*(self.tags.get(tag, set()) for tag in key))
+				result = [document.filename for document in self.documents if document.filename in matches]
+			else:
+				result = [document.filename for document in self.documents]
+			self.queries[key] = result
+		return result
+
+	def path(self, filename):
+		return os.path.join(self.directory, filename)
+
+	def digest(self, filename):
+		# content hash of a document, computed once per (size, mtime)
+		document = self.by_filename[filename]
+		key = (document.size, document.mtime)
+		cached = self.digests.get(filename)
+		if cached is None or cached[0] != key:
+			digest = hashlib.sha256()
+			with open(self.path(filename), 'rb') as handler:
+				for chunk in iter(lambda: handler.read(1 << 20), b''):
+					digest.update(chunk)
+			cached = (key, digest.hexdigest())
+			self.remember(filename, *cached)
+		return cached[1]
+
+	def remember(self, filename, key, digest):
+		self.digests[filename] = (key, digest)
+		self.blobs[digest].add(filename)
+
+	def crc32(self, filename):
+		# only read here for documents the indexer has not reached yet
+		digest = self.digest(filename)
+		checksum = self.checksums.get(digest)
+		if checksum is None:
+			checksum = 0
+			with open(self.path(filename), 'rb') as handler:
+				for chunk in iter(lambda: handler.read(1 << 20), b''):
+					checksum = zlib.crc32(chunk, checksum)
+			self.checksums[digest] = checksum
+		return checksum
+
+	def cached_digest(self, filename):
+		# the content hash if it is already known, never reads the file
+		document = self.by_filename.get(filename)
+		cached = self.digests.get(filename)
+		if document is None or cached is None or cached[0] != (document.size, document.mtime):
+			return None
+		return cached[1]
+
+	def blob(self, digest, name=None):
+		# filename serving a content hash, identical documents under different names share the first one. Only the
+		# known digests are looked at, a name whose digest is not known yet is the one file that gets hashed
+		self.get()
+		if name in self.by_filename and self.cached_digest(name) is None:
+			self.digest(name)
+		filenames = self.blobs.get(digest, ())
+		current = sorted(filename for filename in filenames if self.cached_digest(filename) == digest)
+		if len(current) != len(filenames):
+			# renamed, changed or deleted since
+			self.blobs[digest] = set(current)
+		return current[0] if current else None
+
+	def count(self, *tags):
+		self.get()
+		key = tuple(sorted(set(tags)))
+		if not key:
+			return len(self.documents)
+		if len(key) == 1:
+			return self.tag_counts.get(key[0], 0)
+		if len(key) == 2:
+			return self.pair_counts.get(key, 0)
+		return len(self.filenames(*key))
+
+	def facets(self, *tags):
+		# document counts per tag among the documents carrying all of the given tags
+		self.get()
+		key = tuple(sorted(set(tags)))
+		if not key:
+			return dict(self.tag_counts)
+		if len(key) == 1:
+			facets = {key[0]: self.tag_counts.get(key[0], 0)}
+			for (first, second), count in self.pair_counts.items():
+				if first == key[0]:
+					facets[second] = count
+				elif second == key[0]:
+					facets[first] = count
+			return facets
+		return dict(Counter(tag for filename in self.filenames(*key) for tag in set(self.by_filename[filename].tags)))
+
+document_catalog = DocumentCatalog(docsdir, app.config['DOCUMENTS_REFRESH_INTERVAL'])
+document_catalog.refresh()
+
+
+#[Document Metadata]====================================================================================================
+# Page count, pdf title/author, content hash and crc32 of every document, extracted in a process pool by a background
+# thread and kept in a sqlite sidecar, so only new or changed files are ever opened and never on a request
+
+def extract_document(filename):
+	stat = os.stat(filename)
+	digest = hashlib.sha256()
+	checksum = 0
+	with open(filename, 'rb') as handler:
+		for chunk in iter(lambda: handler.read(1 << 20), b''):
+			digest.update(chunk)
+			checksum = zlib.crc32(chunk, checksum)
+	pages = title = author = None
+	if PdfReader is not None and filename.lower().endswith('.pdf'):
+		try:
+			reader = PdfReader(filename)
+			pages = len(reader.pages)
+			if reader.metadata is not None:
+				title = str(reader.metadata.title) if reader.metadata.title else None
+				author = str(reader.metadata.author) if reader.metadata.author else None
+		except Exception:
+			pass
+	return dict(size=stat.st_size, mtime=stat.st_mtime_ns, sha256=digest.hexdigest(), crc32=checksum, pages=pages, title=title, author=author)
+
+def process_pool(tasks):
+	# forked explicitly, spawned workers would re-import the whole app
+	workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+	context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+	return ProcessPoolExecutor(max_workers=max(min(workers, tasks), 1), mp_context=context)
+
+class DocumentIndexer:
+	columns = ('size', 'mtime', 'sha256', 'crc32', 'pages', 'title', 'author')
+
+	def __init__(self, catalog, database):
+		self.catalog = catalog
+		self.database = database
+		self.started = False
+		self.dirty = False
+		self.thread = None
+		self.listeners = [] # called after indexing, still holding the extraction lock
+		self.lock = threading.Lock()
+
+	def start(self):
+		# the pool forks, so indexing only begins once the app module has finished importing
+		if not self.started:
+			self.started = True
+			self.schedule()
+
+	def connect(self):
+		os.makedirs(os.path.dirname(self.database), exist_ok=True)
+		connection = sqlite3.connect(self.database, timeout=30)
+		connection.execute("CREATE TABLE IF NOT EXISTS documents (filename TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, sha256 TEXT, crc32 INTEGER, pages INTEGER, title TEXT, author TEXT)")
+		# sidecars from before the crc32 column, their rows are extracted again on the next index
+		if 'crc32' not in {row[1] for row in connection.execute("PRAGMA table_info(documents)")}:
+			with connection:
+				connection.execute("ALTER TABLE documents ADD COLUMN crc32 INTEGER")
+		return connection
+
+	def install(self, filename, info):
+		self.catalog.info[filename] = info
+		self.catalog.remember(filename, (info['size'], info['mtime']), info['sha256'])
+		self.catalog.checksums[info['sha256']] = info['crc32']
+
+	def schedule(self):
+		with self.lock:
+			self.dirty = True
+			if self.started and self.thread is None:
+				self.thread = threading.Thread(target=self.run, daemon=True)
+				self.thread.start()
+
+	def run(self):
+		while True:
+			with self.lock:
+				if not self.dirty:
+					self.thread = None
+					return
+				self.dirty = False
+			try:
+				self.index()
+			except Exception:
+				app.logger.exception("document indexing failed")
+
+	def index(self):
+		lockfile = open(self.database + '.lock', 'w')
+		try:
+			# one worker extracts, the others wait here and then just read its results
+			if fcntl is not None:
+				fcntl.flock(lockfile, fcntl.LOCK_EX)
+			connection = self.connect()
+			with connection:
+				rows = {row[0]: dict(zip(self.columns, row[1:])) for row in connection.execute(f"SELECT filename, {', '.join(self.columns)} FROM documents")}
+				documents = self.catalog.documents
+				stale = []
+				for document in documents:
+					info = rows.get(document.filename)
+					if info is not None and (info['size'], info['mtime']) == (document.size, document.mtime) and info['crc32'] is not None:
+						self.install(document.filename, info)
+					else:
+						stale.append(document.filename)
+				live = {document.filename for document in documents}
+				connection.executemany("DELETE FROM documents WHERE filename = ?", [(filename,) for filename in rows if filename not in live])
+				for filename in [filename for filename in self.catalog.info if filename not in live]:
+					del self.catalog.info[filename]
+			if stale:
+				with process_pool(len(stale)) as executor:
+					for filename, info in zip(stale, executor.map(extract_document, [self.catalog.path(filename) for filename in stale])):
+						with connection:
+							connection.execute(f"INSERT OR REPLACE INTO documents (filename, {', '.join(self.columns)}) VALUES ({', '.join('?' * (len(self.columns) + 1))})", (filename,) + tuple(info[column] for column in self.columns))
+						self.install(filename, info)
+			connection.close()
+			for listener in self.listeners:
+				listener()
+		finally:
+			lockfile.close()
+
+document_indexer = DocumentIndexer(document_catalog, app.config['DOCUMENT_INDEX_FILE'])
+document_catalog.listeners.append(document_indexer.schedule)
+
+@app.before_request
+def start_document_indexer():
+	document_indexer.start()
+
+@app.cli.command('index-documents')
+def index_documents_command():
+	"""Extract the metadata of new or changed documents into the sidecar index."""
+	document_indexer.index()
+	for document in document_catalog.documents:
+		click.echo(f"{document.filename}  {document_summary(document.filename)}")
+
+@app.template_filter('document_summary')
+def document_summary(filename):
+	document = document_catalog.by_filename.get(filename)
+	if document is None:
+		return ''
+	info = document_catalog.info.get(filename, {})
+	parts = [f"{document.size / (1 << 20):.1f} MB"]
+	if info.get('pages'):
+		parts.append(f"{info['pages']} pages")
+	if info.get('author'):
+		parts.append(info['author'])
+	return ' · '.join(parts)
+
+
+#[Document Search]======================================================================================================
+# Full text search inside the documents. Page texts are tokenized once per content hash in a process pool and cached,
+# the pages of all documents are then indexed into a varint compressed file that every worker memory maps
+
+def extract_pages(filename):
+	pages = []
+	if PdfReader is not None:
+		try:
+			for page in PdfReader(filename).pages:
+				pages.append(Counter(tokenize(page.extract_text() or '')))
+		except Exception:
+			pass
+	return pages
+
+class DocumentSearch:
+	def __init__(self, catalog, filename, textdir):
+		self.catalog = catalog
+		self.filename = filename
+		self.textdir = textdir
+		self.segment = None
+		self.avgdl = 1
+
+	def open(self):
+		try:
+			segment = CompressedSegment(self.filename)
+		except (FileNotFoundError, ValueError, struct.error):
+			segment = None
+		if segment is not None:
+			units = segment.docs['units']
+			self.avgdl = sum(length for _, _, length in units) / len(units) if units else 1
+		self.segment = segment
+
+	def textfile(self, digest):
+		return os.path.join(self.textdir, digest + '.json.gz')
+
+	def update(self):
+		# runs in the document indexer thread, other workers wait for the lock and then only map the new file
+		hashes = {filename: info['sha256'] for filename, info in self.catalog.info.items()}
+		if self.segment is None or self.segment.docs['documents'] != hashes:
+			self.open()
+		if self.segment is not None and self.segment.docs['documents'] == hashes:
+			return
+		os.makedirs(self.textdir, exist_ok=True)
+		missing = sorted({digest: filename for filename, digest in hashes.items() if not os.path.exists(self.textfile(digest))}.items())
+		if missing:
+			with process_pool(len(missing)) as executor:
+				for (digest, filename), pages in zip(missing, executor.map(extract_pages, [self.catalog.path(filename) for _, filename in missing])):
+					with gzip.open(self.textfile(digest) + '.tmp', 'wt', encoding='utf-8') as handler:
+						json.dump(pages, handler)
+					os.replace(self.textfile(digest) + '.tmp', self.textfile(digest))
+		units = [] # [filename, page number, length]
+		postings = defaultdict(list)
+		for filename in sorted(hashes):
+			with gzip.open(self.textfile(hashes[filename]), 'rt', encoding='utf-8') as handler:
+				pages = json.load(handler)
+			for number, terms in enumerate(pages, 1):
+				if terms:
+					for term, tf in terms.items():
+						postings[term].append((len(units), tf))
+					units.append([filename, number, sum(terms.values())])
+		CompressedSegment.write(self.filename, {'documents': hashes, 'units': units}, postings)
+		self.open()
+
+	def search(self, query, limit=20, pages=5):
+		# ranks documents by their best matching page, returns (filename, [page numbers best first])
+		segment = self.segment
+		terms = tokenize(query)
+		if segment is None or not terms:
+			return []
+		units = segment.docs['units']
+		scores = defaultdict(float)
+		for position, term in enumerate(terms):
+			for i in segment.find(term, prefix=position == len(terms) - 1)[:50]:
+				matches = list(segment.postings_for(i))
+				idf = inverse_frequency(len(units), len(matches))
+				for unit, tf in matches:
+					scores[unit] += bm25(idf, tf, units[unit][2], self.avgdl)
+		by_document = defaultdict(list)
+		for unit, score in scores.items():
+			by_document[units[unit][0]].append((score, units[unit][1]))
+		ranked = heapq.nlargest(limit, by_document.items(), key=lambda item: max(item[1]))
+		return [(filename, [number for _, number in sorted(hits, reverse=True)[:pages]]) for filename, hits in ranked]
+
+document_search = DocumentSearch(document_catalog, app.config['DOCUMENT_SEARCH_FILE'], app.config['DOCUMENT_TEXT_DIR'])
+document_search.open()
+document_indexer.listeners.append(document_search.update)
+
+
+#[Downloads]============================================================================================================
+# Serve documents with strong content ETags and byte ranges. Responses running to the end of the file go through
+# wsgi.file_wrapper, which gunicorn transmits with os.sendfile from the current offset
+
+def read_range(handler, length, buffer_size=1 << 16):
+	try:
+		while length > 0:
+			chunk = handler.read(min(buffer_size, length))
+			if not chunk:
+				break
+			length -= len(chunk)
+			yield chunk
+	finally:
+		handler.close()
+
+def offload_response(parts, length, **kwargs):
+	# parts are bytes or (path, offset, length). The body is only a manifest of them, which the front end (asgi.py)
+	# sends on its event loop, so the worker thread is free again as soon as the headers are built. The header carries
+	# the real Content-Length, the front end swaps it in
+	manifest = [{'data': base64.b64encode(part).decode()} if isinstance(part, bytes) else dict(zip(('path', 'offset', 'length'), part)) for part in parts]
+	response = Response(json.dumps(manifest), **kwargs)
+	response.headers[app.config['DOCUMENT_OFFLOAD_HEADER']] = str(length)
+	return response
+
+def iter_parts(parts):
+	for part in parts:
+		if isinstance(part, bytes):
+			yield part
+		else:
+			path, offset, length = part
+			handler = open(path, 'rb')
+			handler.seek(offset)
+			yield from read_range(handler, length)
+
+def send_document(document, as_attachment=True, immutable=False):
+	etag = document_catalog.digest(document.filename)
+	last_modified = datetime.fromtimestamp(document.mtime / 1e9, timezone.utc).replace(microsecond=0)
+	size = document.size
+	if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+		response = Response(status=304)
+	else:
+		start, stop, status = 0, size, 200
+		if request.range is not None:
+			# If-Range only allows the partial response while the client's copy is still current, and a date is a strong
+			# validator only on an exact match. Several ranges are answered with the whole file, which RFC 9110 allows
+			if_range = request.if_range
+			current = 'If-Range' not in request.headers or if_range.etag == etag or (if_range.date is not None and if_range.date == last_modified)
+			if current and len(request.range.ranges) == 1:
+				span = request.range.range_for_length(size)
+				if span is None:
+					response = Response(status=416)
+					response.headers['Content-Range'] = f"bytes */{size}"
+					return response
+				start, stop = span
+				status = 206
+		mimetype = mimetypes.guess_type(document.filename)[0] or 'application/octet-stream'
+		if app.config['DOCUMENT_OFFLOAD_HEADER']:
+			response = offload_response([(document_catalog.path(document.filename), start, stop - start)], stop - start, status=status, mimetype=mimetype)
+		else:
+			handler = open(document_catalog.path(document.filename), 'rb')
+			handler.seek(start)
+			if stop == size:
+				body = wrap_file(request.environ, handler)
+			else:
+				body = read_range(handler, stop - start)
+			response = Response(body, status=status, mimetype=mimetype, direct_passthrough=True)
+			response.content_length = stop - start
+		if status == 206:
+			response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+		disposition = 'attachment' if as_attachment else 'inline'
+		try:
+			document.filename.encode('ascii')
+			response.headers.set('Content-Disposition', disposition, filename=document.filename)
+		except UnicodeEncodeError:
+			response.headers.set('Content-Disposition', disposition, filename=document.filename.encode('ascii', 'ignore').decode(), **{'filename*': "UTF-8''" + quote(document.filename)})
+	response.accept_ranges = 'bytes'
+	response.set_etag(etag)
+	response.last_modified = last_modified
+	response.cache_control.public = True
+	if immutable:
+		response.cache_control.max_age = app.config['DOCUMENT_BLOB_MAX_AGE']
+		response.cache_control.immutable = True
+	else:
+		response.cache_control.max_age = app.config['DOCUMENT_MAX_AGE']
+	return response
+
+def dos_datetime(mtime):
+	moment = datetime.fromtimestamp(mtime / 1e9)
+	if moment.year < 1980:
+		return 0, 0x21
+	return moment.hour << 11 | moment.minute << 5 | moment.second // 2, (moment.year - 1980) << 9 | moment.month << 5 | moment.day
+
+def zip_length(documents):
+	# local header and central directory entry per file, then the end record, as zip_parts lays them out
+	return sum(30 + 46 + 2 * len(document.filename.encode()) + document.size for document in documents) + 22
+
+def zip_parts(documents):
+	# a stored zip: with the crc32 of every file cached, all headers and so the total length are known before sending
+	parts, directory, offset = [], [], 0
+	for document in documents:
+		name = document.filename.encode()
+		crc, size = document_catalog.crc32(document.filename), document.size
+		dostime, dosdate = dos_datetime(document.mtime)
+		# bit 11 marks utf-8 names
+		local = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x800, 0, dostime, dosdate, crc, size, size, len(name), 0) + name
+		directory.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 0x314, 20, 0x800, 0, dostime, dosdate, crc, size, size, len(name), 0, 0, 0, 0, 0o100644 << 16, offset) + name)
+		parts += [local, (document_catalog.path(document.filename), 0, size)]
+		offset += len(local) + size
+	directory = b''.join(directory)
+	parts.append(directory + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(documents), len(documents), len(directory), offset, 0))
+	return parts, offset + len(directory) + 22
+
+@app.template_global()
+def document_url(filename, **values):
+	# content addressed url when the hash is known, otherwise the named route which hashes and redirects
+	digest = document_catalog.cached_digest(filename)
+	if digest is None:
+		return url_for('download_file', filename=filename, **values)
+	return url_for('document_blob', digest=digest, name=document_catalog.blob(digest), **values)
+
+
+#[Counters]=============================================================================================================
+# Downloads and page views are counted in memory and written in batches by a background thread, so requests never
+# touch the database. Every worker adds its own increments to the shared WAL mode database
+
+class Counters:
+	def __init__(self, database, interval):
+		self.database = database
+		self.interval = interval
+		self.pending = Counter() # (kind, key) -> increments not written yet
+		self.flushing = Counter() # (kind, key) -> increments being written, still counted until the totals are reread
+		self.totals = {} # kind -> (time read, {key: count})
+		self.thread = None
+		self.lock = threading.Lock()
+
+	def connect(self):
+		os.makedirs(os.path.dirname(self.database), exist_ok=True)
+		connection = sqlite3.connect(self.database, timeout=30)
+		connection.execute("PRAGMA journal_mode=WAL")
+		connection.execute("PRAGMA synchronous=NORMAL")
+		connection.execute("CREATE TABLE IF NOT EXISTS counters (kind TEXT, key TEXT, count INTEGER, PRIMARY KEY (kind, key)) WITHOUT ROWID")
+		return connection
+
+	def increment(self, kind, key, amount=1):
+		if not app.config['COUNTERS']:
+			return
+		with self.lock:
+			self.pending[kind, key] += amount
+			if self.thread is None:
+				# started lazily, so every forked worker runs its own
+				self.thread = threading.Thread(target=self.run, daemon=True)
+				self.thread.start()
+
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			try:
+				self.flush()
+			except Exception:
+				app.logger.exception("counter flush failed")
+
+	def flush(self):
+		with self.lock:
+			pending, self.pending = self.pending, Counter()
+			self.flushing = pending
+		if not pending:
+			return
+		connection = self.connect()
+		try:
+			with connection:
+				connection.executemany("INSERT INTO counters VALUES (?, ?, ?) ON CONFLICT (kind, key) DO UPDATE SET count = count + excluded.count", [(kind, key, count) for (kind, key), count in pending.items()])
+		except sqlite3.Error:
+			# keep the increments for the next flush rather than losing them
+			with self.lock:
+				self.pending.update(pending)
+				self.flushing = Counter()
+			raise
+		finally:
+			connection.close()
+		# the written increments are in the database now, the cached totals are not
+		with self.lock:
+			self.flushing, self.totals = Counter(), {}
+
+	def reset(self):
+		# the parent's increments are its own to write, a forked child starts empty and without a flush thread
+		self.lock = threading.Lock()
+		self.pending, self.flushing, self.thread = Counter(), Counter(), None
+
+	def counts(self, kind):
+		# totals of all workers, read at most once per flush interval, plus this worker's unwritten increments
+		with self.lock:
+			cached = self.totals.get(kind)
+			unwritten = self.pending + self.flushing
+		if cached is None or time.monotonic() - cached[0] > self.interval:
+			connection = self.connect()
+			try:
+				with self.lock:
+					# under the lock, so a flush cannot drop its increments between this read and the snapshot below
+					cached = (time.monotonic(), dict(connection.execute("SELECT key, count FROM counters WHERE kind = ?", (kind,))))
+					unwritten = self.pending + self.flushing
+					self.totals[kind] = cached
+			finally:
+				connection.close()
+		counts = Counter(cached[1])
+		for (pending_kind, key), count in unwritten.items():
+			if pending_kind == kind:
+				counts[key] += count
+		return counts
+
+	def top(self, kind, limit=10):
+		return self.counts(kind).most_common(limit)
+
+counters = Counters(app.config['COUNTERS_FILE'], app.config['COUNTERS_FLUSH_INTERVAL'])
+os.register_at_fork(after_in_child=counters.reset)
+atexit.register(counters.flush)
+
+@app.template_filter('by_popularity')
+def by_popularity(filenames, kind='download'):
+	# most downloaded first, ties keep their order
+	counts = counters.counts(kind)
+	return sorted(filenames, key=lambda filename: -counts[filename])
+
+@app.template_global()
+def popular_documents(limit=5):
+	return [filename for filename, _ in counters.top('download', limit) if filename in document_catalog.by_filename]
+
+
+#[Download Limits]======================================================================================================
+# Token buckets of bytes and a count of running downloads per client, kept in a small SQLite database so that all the
+# workers see the same numbers. A download is charged its full length before it is sent, a client in debt has to wait
+
+class DownloadLimiter:
+	def __init__(self, database, rate, burst, concurrency):
+		self.database = database
+		self.rate = rate
+		self.burst = burst
+		self.concurrency = concurrency
+		self.local = threading.local()
+		self.pruned = 0
+
+	def connect(self):
+		# one connection per thread, and a fresh one in forked workers
+		if getattr(self.local, 'pid', None) != os.getpid():
+			os.makedirs(os.path.dirname(self.database), exist_ok=True)
+			connection = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+			connection.execute("PRAGMA journal_mode=WAL")
+			# the state only matters while the server runs, there is nothing to lose on a crash
+			connection.execute("PRAGMA synchronous=OFF")
+			connection.execute("CREATE TABLE IF NOT EXISTS buckets (client TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+			connection.execute("CREATE TABLE IF NOT EXISTS slots (id INTEGER PRIMARY KEY, client TEXT, pid INTEGER)")
+			connection.execute("CREATE INDEX IF NOT EXISTS slots_client ON slots (client)")
+			self.local.connection, self.local.pid = connection, os.getpid()
+		return self.local.connection
+
+	def tokens(self, connection, client, now):
+		row = connection.execute("SELECT tokens, updated FROM buckets WHERE client = ?", (client,)).fetchone()
+		if row is None:
+			return self.burst
+		return min(self.burst, row[0] + (now - row[1]) * self.rate)
+
+	def acquire(self, client, length=0):
+		# takes a slot and charges length bytes up front, returns (slot id, None) or (None, seconds to wait)
+		connection = self.connect()
+		now = time.time()
+		connection.execute("BEGIN IMMEDIATE")
+		try:
+			if now - self.pruned > 60:
+				# buckets that have refilled completely are the same as no bucket
+				connection.execute("DELETE FROM buckets WHERE updated < ?", (now - self.burst / self.rate,))
+				self.pruned = now
+			slots = connection.execute("SELECT id, pid FROM slots WHERE client = ?", (client,)).fetchall()
+			# slots of workers that died mid download would otherwise be held forever
+			dead = [(slot,) for slot, pid in slots if not pid_alive(pid)]
+			connection.executemany("DELETE FROM slots WHERE id = ?", dead)
+			tokens = self.tokens(connection, client, now)
+			if len(slots) - len(dead) >= self.concurrency:
+				return None, 5
+			if tokens <= 0:
+				return None, math.ceil(-tokens / self.rate) or 1
+			slot = connection.execute("INSERT INTO slots (client, pid) VALUES (?, ?)", (client, os.getpid())).lastrowid
+			if length:
+				connection.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (client, tokens - length, now))
+			return slot, None
+		finally:
+			connection.execute("COMMIT")
+
+	def release(self, slot):
+		self.connect().execute("DELETE FROM slots WHERE id = ?", (slot,))
+
+def pid_alive(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+download_limiter = DownloadLimiter(app.config['DOWNLOAD_LIMITS_FILE'], app.config['DOWNLOAD_RATE'], app.config['DOWNLOAD_BURST'], app.config['DOWNLOAD_CONCURRENCY'])
+
+def download_limited(view):
+	# html routes stay unthrottled, only the views sending document bodies take a slot. The views put the counter
+	# of what they send in g.download, it is only counted once the body is allowed out
+	@wraps(view)
+	def limited(*args, **kwargs):
+		# the view only builds the response, its length is charged before any of the body goes out
+		response = view(*args, **kwargs)
+		offload = app.config['DOCUMENT_OFFLOAD_HEADER']
+		offloaded = offload is not None and offload in response.headers
+		length = 0
+		if request.method == 'GET' and response.status_code in (200, 206):
+			length = int(response.headers[offload]) if offloaded else response.content_length or 0
+		# HEAD and 304 revalidations send no body, they never wait on a bucket in debt
+		if app.config['DOWNLOAD_LIMITS'] and length:
+			slot, retry_after = download_limiter.acquire(request.remote_addr or '', length)
+			if slot is None:
+				response.close()
+				response = Response("Too many downloads, try again later.\n", status=429, mimetype='text/plain')
+				response.retry_after = retry_after
+				return response
+			if offloaded:
+				# the front end sends the body after this view has returned, it frees the slot when it is done
+				response.headers[app.config['DOCUMENT_RELEASE_HEADER']] = str(slot)
+			else:
+				call_after_body(response, lambda: download_limiter.release(slot))
+		# pdf viewers and resumed downloads fetch later ranges, only count transfers from the first byte
+		if request.method == 'GET' and g.get('download') and (response.status_code == 200 or (response.status_code == 206 and response.headers['Content-Range'].startswith('bytes 0-'))):
+			counters.increment(*g.download)
+		return response
+	return limited
+
+def call_after_body(response, callback):
+	# call_on_close is skipped for direct passthrough bodies, so hook the body itself, keeping file wrappers intact
+	# for sendfile
+	body = response.response
+	if not response.direct_passthrough:
+		response.call_on_close(callback)
+	elif hasattr(body, 'filelike'):
+		close = body.close
+		def closing():
+			try:
+				close()
+			finally:
+				callback()
+		body.close = closing
+	else:
+		response.response = ClosingIterator(body, callback)
+
+
+#[Watcher]==============================================================================================================
+# Refresh the indexes from filesystem events in a background thread, so requests never stat files
+
+class Watcher:
+	def __init__(self, delay=0.2):
+		self.delay = delay # seconds to wait for a burst of events to settle
+		self.callbacks = {} # directory -> refresh function
+		self.pending = set()
+		self.timer = None
+		self.observer = None
+		self.lock = threading.Lock()
+
+	def watch(self, directory, callback):
+		self.callbacks[os.path.realpath(directory)] = callback
+
+	def dispatch(self, event):
+		# reads by the refresh functions raise opened/closed events, only react to real changes
+		if event.event_type not in ('created', 'deleted', 'modified', 'moved'):
+			return
+		paths = [os.path.realpath(os.fsdecode(event.src_path))]
+		if getattr(event, 'dest_path', None):
+			paths.append(os.path.realpath(os.fsdecode(event.dest_path)))
+		for directory in self.callbacks:
+			if any(path == directory or path.startswith(directory + os.sep) for path in paths):
+				with self.lock:
+					self.pending.add(directory)
+					if self.timer is None:
+						self.timer = threading.Timer(self.delay, self.flush)
+						self.timer.daemon = True
+						self.timer.start()
+
+	def flush(self):
+		with self.lock:
+			pending, self.pending, self.timer = self.pending, set(), None
+		for directory in pending:
+			try:
+				self.callbacks[directory]()
+			except Exception:
+				app.logger.exception("refresh of %s failed", directory)
+
+	def start(self):
+		if Observer is None:
+			return False
+		handler = FileSystemEventHandler()
+		handler.on_any_event = self.dispatch
+		observer = Observer()
+		for directory in self.callbacks:
+			observer.schedule(handler, directory, recursive=True)
+		observer.daemon = True
+		observer.start()
+		self.observer = observer
+		return True
+
+	def restart(self):
+		# threads do not survive fork, gunicorn workers forked from a preloaded app start their own from the post_fork
+		# hook in gunicorn.conf.py. Not an at-fork hook, process pool children must not start observers or refresh
+		self.lock = threading.Lock()
+		self.pending, self.timer = set(), None
+		if self.observer is not None:
+			self.start()
+			for directory, callback in self.callbacks.items():
+				callback()
+
+watcher = Watcher()
+watcher.watch(pagesdir, post_index.refresh)
+watcher.watch(docsdir, document_catalog.refresh)
+
+if app.config['WATCH_FILES'] and watcher.start():
+	post_index.interval = float('inf')
+	document_catalog.watched = True
+
+
+#[Assets]===============================================================================================================
+# Every static file gets a content hash in its name at startup, url_for('static') emits the fingerprinted name and
+# those responses are cached for good. Documents have their own content addressed urls
+
+fingerprint_pattern = re.compile(r'^(.*)\.([0-9a-f]{12})(\.[^./]+)?$')
+
+def fingerprint(filename, digest):
+	root, extension = os.path.splitext(filename)
+	return f"{root}.{digest[:12]}{extension}"
+
+class AssetManifest:
+	def __init__(self, directory, exclude=()):
+		self.directory = directory
+		self.exclude = exclude
+		self.hashed = {} # filename -> fingerprinted filename
+		self.originals = {} # fingerprinted filename -> filename
+		self.stats = {} # filename -> (size, mtime) its fingerprint was made from
+
+	def build(self):
+		hashed, stats = {}, {}
+		for cur_path, dirnames, filenames in os.walk(self.directory):
+			dirnames[:] = [dirname for dirname in dirnames if os.path.join(cur_path, dirname) not in self.exclude]
+			for name in filenames:
+				if name.endswith(('.gz', '.br')) and name[:-3] in filenames:
+					continue
+				path = os.path.join(cur_path, name)
+				filename = os.path.relpath(path, self.directory).replace(os.sep, '/')
+				stat = os.stat(path)
+				stats[filename] = (stat.st_size, stat.st_mtime_ns)
+				hashed[filename] = fingerprint(filename, self.digest(path))
+		self.hashed, self.stats, self.originals = hashed, stats, {value: key for key, value in hashed.items()}
+
+	def digest(self, path):
+		digest = hashlib.sha256()
+		with open(path, 'rb') as handler:
+			for chunk in iter(lambda: handler.read(1 << 20), b''):
+				digest.update(chunk)
+		return digest.hexdigest()
+
+	def current(self, filename):
+		# whether the file still holds the content its fingerprint was made from, rehashed only when its stat changed
+		try:
+			stat = os.stat(os.path.join(self.directory, filename))
+		except OSError:
+			return False
+		key = (stat.st_size, stat.st_mtime_ns)
+		if self.stats.get(filename) != key:
+			if fingerprint(filename, self.digest(os.path.join(self.directory, filename))) != self.hashed[filename]:
+				return False
+			self.stats[filename] = key
+		return True
+
+asset_manifest = AssetManifest(app.static_folder, exclude=(docsdir,))
+asset_manifest.build()
+
+@app.url_defaults
+def fingerprint_static(endpoint, values):
+	if endpoint == 'static' and values.get('filename') in asset_manifest.hashed:
+		values['filename'] = asset_manifest.hashed[values['filename']]
+
+static_encodings = (('br', '.br'), ('gzip', '.gz'))
+# the only types the static route sends precompressed, other text files under static are never requested that way
+static_compressible_types = ('text/css', 'text/javascript', 'application/javascript', 'text/html', 'application/json', 'image/svg+xml', 'font/ttf', 'font/otf', 'application/vnd.ms-fontobject')
+
+def is_static_compressible(mimetype):
+	return mimetype in static_compressible_types
+
+def send_static_asset(filename):
+	# text files are sent from the .br or .gz sibling written by flask compress-static when the client takes it
+	mimetype = mimetypes.guess_type(filename)[0]
+	if not is_static_compressible(mimetype):
+		return app.send_static_file(filename)
+	path = safe_join(app.static_folder, filename)
+	response = None
+	if path is not None and os.path.isfile(path):
+		mtime = os.stat(path).st_mtime_ns
+		for encoding, suffix in static_encodings:
+			# siblings carry the mtime of their original, anything else is left over from an older version
+			if request.accept_encodings[encoding] and os.path.isfile(path + suffix) and os.stat(path + suffix).st_mtime_ns == mtime:
+				response = send_file(path + suffix, mimetype=mimetype, download_name=os.path.basename(filename), max_age=app.get_send_file_max_age(filename))
+				response.content_encoding = encoding
+				break
+	if response is None:
+		response = app.send_static_file(filename)
+	response.vary.add('Accept-Encoding')
+	return response
+
+def static_file(filename):
+	original = asset_manifest.originals.get(filename)
+	if original is None:
+		match = fingerprint_pattern.match(filename)
+		# a fingerprint from an older deploy still gets the current file, just not cached for good
+		return send_static_asset(match.group(1) + (match.group(3) or '') if match else filename)
+	if not asset_manifest.current(original):
+		# edited since startup, the fingerprint no longer describes these bytes
+		return send_static_asset(original)
+	response = send_static_asset(original)
+	response.cache_control.no_cache = None
+	response.cache_control.public = True
+	response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+	response.cache_control.immutable = True
+	return response
+
+app.view_functions['static'] = static_file
+
+
+#[Images]===============================================================================================================
+# Width stepped webp/avif variants of the static images, written to static/responsive by flask build-images across a
+# process pool as part of flask build. Sources whose hash has not changed are skipped. The picture() helper turns them
+# into srcset markup, and falls back to a plain <img> until they are built
+
+image_dir = os.path.join(app.static_folder, 'responsive')
+image_manifest_file = os.path.join(image_dir, 'manifest.json')
+image_formats = (('avif', 'image/avif', dict(quality=55)), ('webp', 'image/webp', dict(quality=80, method=6)))
+
+def build_image(filename, widths):
+	# runs in the pool, returns the manifest entry of one source image
+	source = os.path.join(app.static_folder, filename)
+	with open(source, 'rb') as handler:
+		data = handler.read()
+	image = ImageOps.exif_transpose(Image.open(source))
+	if image.mode not in ('RGB', 'RGBA'):
+		image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+	# nothing from the original (exif, icc, comments) is carried over
+	image.info = {}
+	width, height = image.size
+	root = os.path.splitext(filename)[0]
+	variants = {extension: [] for extension, _, _ in image_formats}
+	for step in sorted({step for step in widths if step < width} | {min(width, max(widths))}):
+		resized = image if step == width else image.resize((step, round(height * step / width)), Image.LANCZOS)
+		for extension, _, options in image_formats:
+			variant = f"responsive/{root}-{step}.{extension}"
+			target = os.path.join(app.static_folder, variant)
+			os.makedirs(os.path.dirname(target), exist_ok=True)
+			resized.save(target, extension.upper(), **options)
+			variants[extension].append([step, variant])
+	return dict(sha256=hashlib.sha256(data).hexdigest(), width=width, height=height, variants=variants)
+
+def load_image_manifest():
+	try:
+		with open(image_manifest_file) as handler:
+			return json.load(handler)
+	except FileNotFoundError:
+		return {}
+
+image_manifest = load_image_manifest()
+
+@app.cli.command('build-images')
+def build_images():
+	"""Write resized webp/avif variants of the static images and their manifest."""
+	global image_manifest
+	if Image is None:
+		raise click.ClickException("Pillow is not installed")
+	previous = load_image_manifest()
+	manifest, stale = {}, []
+	for directory in app.config['IMAGE_DIRS']:
+		for cur_path, _, filenames in os.walk(os.path.join(app.static_folder, directory)):
+			for name in sorted(filenames):
+				if not name.lower().endswith(('.jpg', '.jpeg', '.png')):
+					continue
+				filename = os.path.relpath(os.path.join(cur_path, name), app.static_folder).replace(os.sep, '/')
+				entry = previous.get(filename)
+				with open(os.path.join(app.static_folder, filename), 'rb') as handler:
+					digest = hashlib.sha256(handler.read()).hexdigest()
+				if entry is not None and entry['sha256'] == digest and all(os.path.isfile(os.path.join(app.static_folder, variant)) for variants in entry['variants'].values() for _, variant in variants):
+					manifest[filename] = entry
+				else:
+					stale.append(filename)
+	if stale:
+		with process_pool(len(stale)) as executor:
+			for filename, entry in zip(stale, executor.map(build_image, stale, [app.config['IMAGE_WIDTHS']] * len(stale))):
+				manifest[filename] = entry
+				original = os.path.getsize(os.path.join(app.static_folder, filename))
+				largest = {extension: variants[-1] for extension, variants in entry['variants'].items()}
+				click.echo(f"{filename} {original / 1024:.0f} KB -> " + ', '.join(f"{extension} {os.path.getsize(os.path.join(app.static_folder, variant)) / 1024:.0f} KB at {step}px" for extension, (step, variant) in largest.items()))
+	# variants of sources that are gone
+	keep = {variant for entry in manifest.values() for variants in entry['variants'].values() for _, variant in variants}
+	for cur_path, _, filenames in os.walk(image_dir):
+		for name in filenames:
+			variant = os.path.relpath(os.path.join(cur_path, name), app.static_folder).replace(os.sep, '/')
+			if variant not in keep and name != 'manifest.json':
+				os.remove(os.path.join(cur_path, name))
+	os.makedirs(image_dir, exist_ok=True)
+	with open(image_manifest_file + '.tmp', 'w') as handler:
+		json.dump(dict(sorted(manifest.items())), handler, indent=1)
+	os.replace(image_manifest_file + '.tmp', image_manifest_file)
+	image_manifest = manifest
+	click.echo(f"{len(stale)} built, {len(manifest) - len(stale)} unchanged")
+
+def html_attributes(attributes):
+	# class_ -> class, fetchpriority stays, data_x -> data-x
+	return ''.join(f' {escape(name.rstrip("_").replace("_", "-"))}="{escape(value)}"' for name, value in attributes.items() if value is not None)
+
+@app.template_global()
+def picture(filename, alt='', sizes=None, **attributes):
+	entry = image_manifest.get(filename)
+	if entry is None:
+		return Markup(f'<img src="{escape(url_for("static", filename=filename))}" alt="{escape(alt)}"{html_attributes(attributes)}>')
+	width, height = entry['width'], entry['height']
+	# by default the image shows at its own width, or the viewport's when that is narrower
+	sizes = sizes or f"(max-width: {width}px) 100vw, {width}px"
+	sources = ''.join(f'<source type="{mimetype}" srcset="{escape(", ".join(url_for("static", filename=variant) + f" {step}w" for step, variant in entry["variants"][extension]))}" sizes="{escape(sizes)}">' for extension, mimetype, _ in image_formats if entry['variants'].get(extension))
+	attributes = dict(dict(loading='lazy', decoding='async'), **attributes)
+	return Markup(f'<picture>{sources}<img src="{escape(url_for("static", filename=filename))}" width="{width}" height="{height}" alt="{escape(alt)}"{html_attributes(attributes)}></picture>')
+
+
+#[Vendor]===============================================================================================================
+# Third party css, fonts and scripts are copied to static/vendor by flask vendor-assets, so the first render does not
+# wait on other origins. Font Awesome is cut down to the icons we use. It runs as part of flask build at deploy time,
+# never on boot. Until it has succeeded the templates keep the cdn urls with their integrity hashes and preconnects
+
+vendor_dir = os.path.join(app.static_folder, 'vendor')
+# what every vendored file was made from, kept out of static so it is not served
+vendor_manifest_file = os.path.join(app.instance_path, 'vendor.json')
+vendor_assets = {
+	# file under static/vendor -> upstream url
+	'fonts/fonts.css': "https://fonts.googleapis.com/css2?family=JetBrains+Mono:wght@300;400;700&family=Inter:wght@300;400;700&display=swap",
+	'fontawesome/css/all.min.css': "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.7.2/css/all.min.css",
+	'bootstrap/bootstrap.min.css': "https://cdn.jsdelivr.net/npm/bootstrap@5.3.8/dist/css/bootstrap.min.css",
+	'bootstrap/bootstrap.bundle.min.js': "https://cdn.jsdelivr.net/npm/bootstrap@5.3.8/dist/js/bootstrap.bundle.min.js",
+	'three/three.core.js': "https://cdn.jsdelivr.net/npm/three@0.180.0/build/three.core.js",
+	'three/three.module.js': "https://cdn.jsdelivr.net/npm/three@0.180.0/build/three.module.js",
+}
+# files that import another one, only vendored once that one is
+vendor_requires = {'three/three.module.js': 'three/three.core.js'}
+# google serves woff2 only to browsers it recognizes
+vendor_user_agent = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36"
+icon_pattern = re.compile(r'\bfa-([a-z0-9-]+)')
+icon_rule_pattern = re.compile(r'([^{}]+)\{content:"\\([0-9a-f]+)"\}')
+icon_selector_pattern = re.compile(r'^\.fa-([a-z0-9-]+)::?before$')
+css_url_pattern = re.compile(r'url\(([^)]+)\)')
+source_map_pattern = re.compile(r'\s*/[/*]# sourceMappingURL=\S+( \*/)?\s*$')
+
+def fetch(url):
+	with urllib.request.urlopen(urllib.request.Request(url, headers={'User-Agent': vendor_user_agent}), timeout=30) as response:
+		return response.read()
+
+def write_vendor(filename, body):
+	path = os.path.join(vendor_dir, filename)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path + '.tmp', 'wb') as handler:
+		handler.write(body)
+	os.replace(path + '.tmp', path)
+	return path
+
+def used_icons():
+	# every fa-* class in the templates, posts and scripts, including the ones cryo.js swaps in
+	icons = set()
+	for directory, extensions in ((app.template_folder, ('.html',)), (app.config['FLATPAGES_ROOT'], ('.md',)), (app.static_folder, ('.js',))):
+		for cur_path, dirnames, filenames in os.walk(os.path.join(app.root_path, directory)):
+			dirnames[:] = [dirname for dirname in dirnames if os.path.join(cur_path, dirname) != vendor_dir]
+			for name in filenames:
+				if name.endswith(extensions):
+					with open(os.path.join(cur_path, name), encoding='utf-8', errors='replace') as handler:
+						icons.update(icon_pattern.findall(handler.read()))
+	return icons
+
+def subset_icon_css(css, icons):
+	# drops the rules of icons nobody uses, returns the css and the codepoints left
+	codepoints = set()
+	def keep(match):
+		selectors = match.group(1).split(',')
+		names = [icon_selector_pattern.match(selector.strip()) for selector in selectors]
+		if not all(names):
+			return match.group(0)
+		selectors = [selector for selector, name in zip(selectors, names) if name.group(1) in icons]
+		if not selectors:
+			return ''
+		codepoints.add(int(match.group(2), 16))
+		return f'{",".join(selectors)}{{content:"\\{match.group(2)}"}}'
+	return icon_rule_pattern.sub(keep, css), codepoints
+
+def subset_font(path, codepoints):
+	options = font_subset.Options()
+	options.flavor = 'woff2'
+	options.layout_features = ['*']
+	font = font_subset.load_font(path, options)
+	subsetter = font_subset.Subsetter(options)
+	subsetter.populate(unicodes=codepoints)
+	subsetter.subset(font)
+	font_subset.save_font(font, path, options)
+
+def vendor_stylesheet(filename, url, icons=None):
+	# fetches every woff2 the stylesheet points at next to it and makes the urls relative, other formats are dropped.
+	# with icons, the sheet and its fonts are cut down to those
+	css = source_map_pattern.sub('', fetch(url).decode())
+	css = re.sub(r',\s*url\([^)]+\)\s*format\("(truetype|opentype|woff|embedded-opentype|svg)"\)', '', css)
+	codepoints = None
+	if icons is not None:
+		css, codepoints = subset_icon_css(css, icons)
+	fonts = {}
+	for reference in dict.fromkeys(reference.strip('\'"') for reference in css_url_pattern.findall(css)):
+		if not urlsplit(reference).path.endswith('.woff2'):
+			continue
+		fonts[reference] = os.path.basename(urlsplit(reference).path) if urlsplit(reference).scheme else reference
+		path = write_vendor(os.path.normpath(os.path.join(os.path.dirname(filename), fonts[reference])), fetch(urljoin(url, reference)))
+		if codepoints is not None and font_subset is not None:
+			subset_font(path, codepoints)
+	css = css_url_pattern.sub(lambda match: 'url(' + fonts.get(match.group(1).strip('\'"'), match.group(1)) + ')', css)
+	write_vendor(filename, css.encode())
+	return [filename] + [os.path.normpath(os.path.join(os.path.dirname(filename), local)).replace(os.sep, '/') for local in fonts.values()]
+
+def load_vendor_manifest():
+	try:
+		with open(vendor_manifest_file) as handler:
+			return json.load(handler)
+	except FileNotFoundError:
+		return {}
+
+@app.cli.command('vendor-assets')
+@click.option('--refresh', is_flag=True, help="Download every file again, even the ones already vendored.")
+def vendor_assets_command(refresh):
+	"""Download the cdn stylesheets, fonts and scripts to static/vendor, with Font Awesome cut down to the icons in use."""
+	if font_subset is None:
+		click.echo("fonttools is not installed, icon fonts are kept whole")
+	# filename -> the url and icons it was made from and the files written for it, so unchanged ones are not fetched
+	previous = load_vendor_manifest()
+	manifest, written, fetched = {}, [], 0
+	for filename, url in vendor_assets.items():
+		if filename in vendor_requires and vendor_requires[filename] not in manifest:
+			click.echo(f"vendor/{filename} skipped, vendor/{vendor_requires[filename]} is missing")
+			continue
+		icons = sorted(used_icons()) if filename.startswith('fontawesome/') else None
+		entry = previous.get(filename)
+		if not refresh and entry is not None and entry['url'] == url and entry['icons'] == icons and all(os.path.isfile(os.path.join(vendor_dir, path)) for path in entry['files']):
+			manifest[filename] = entry
+			continue
+		try:
+			if filename.endswith('.css'):
+				files = vendor_stylesheet(filename, url, icons)
+			else:
+				write_vendor(filename, source_map_pattern.sub('', fetch(url).decode()).encode())
+				files = [filename]
+		except OSError as error:
+			# urllib errors included, the pages keep using the cdn for this one
+			click.echo(f"vendor/{filename} not fetched, {error}")
+			continue
+		manifest[filename] = dict(url=url, icons=icons, files=files)
+		written += files
+		fetched += 1
+	os.makedirs(os.path.dirname(vendor_manifest_file), exist_ok=True)
+	with open(vendor_manifest_file + '.tmp', 'w') as handler:
+		json.dump(manifest, handler, indent=1)
+	os.replace(vendor_manifest_file + '.tmp', vendor_manifest_file)
+	for filename in written:
+		click.echo(f"vendor/{filename} {os.path.getsize(os.path.join(vendor_dir, filename)) / 1024:.1f} KB")
+	click.echo(f"{fetched} fetched, {len(manifest) - fetched} unchanged")
+
+# subresource integrity of the cdn copies, the vendored ones are same origin and a subset may not match it
+vendor_integrity = {
+	'fontawesome/css/all.min.css': "sha512-Evv84Mr4kqVGRNSgIGL/F/aIDqQb7xQ2vcrdIwxfjThSH8CSR7PBEakCr51Ck+w+/U6swU2Im1vVX0SVk9ABhg==",
+	'bootstrap/bootstrap.min.css': "sha384-sRIl4kxILFvY47J16cr9ZwB07vP4J8+LH7qKQnuqkuIAvNWLzeN8tE5YBujZqJLB",
+	'bootstrap/bootstrap.bundle.min.js': "sha384-FKyoEForCGlyvwx9Hj09JcYn3nv7wiPVlz7YYwJrWVcXK/BmnVDxM+D2scQbITxI",
+}
+
+@app.template_global()
+def vendored(filename):
+	return f"vendor/{filename}" in asset_manifest.hashed
+
+@app.template_global()
+def vendor_url(filename):
+	# the vendored copy once flask vendor-assets has written it, the cdn before that
+	if vendored(filename):
+		return url_for('static', filename=f"vendor/{filename}")
+	return vendor_assets[filename]
+
+@app.template_global()
+def vendor_attributes(filename, name='href'):
+	# href/src of a vendored asset, plus integrity and crossorigin while it still comes from the cdn
+	attributes = {name: vendor_url(filename)}
+	if not vendored(filename):
+		attributes.update(integrity=vendor_integrity.get(filename), crossorigin='anonymous', referrerpolicy='no-referrer')
+	return Markup(html_attributes(attributes).strip())
+
+
+#[Critical CSS]=========================================================================================================
+# flask critical-css renders every page, keeps the cryo.css rules that can match what is above the fold and records
+# them per template. Those are inlined in <head> while the whole of cryo.css loads in the background
+
+# a build output read by the app, not an asset, so it stays out of the static tree
+critical_css_file = os.path.join(app.instance_path, 'critical.json')
+css_comment_pattern = re.compile(r'/\*.*?\*/', re.S)
+# pseudo classes and attribute selectors are ignored, so :hover or [data-theme="light"] rules count as matching
+css_pseudo_pattern = re.compile(r'::?[\w-]+(\((?:[^()]|\([^()]*\))*\))?|\[[^\]]*\]')
+css_combinator_pattern = re.compile(r'\s*[>+~]\s*|\s+')
+css_compound_pattern = re.compile(r'([#.]?)([\w-]+)')
+
+def parse_css(css):
+	# [(prelude, body)], body is a list of the same for @media/@supports blocks and the declarations otherwise
+	rules, position = [], 0
+	while True:
+		start = css.find('{', position)
+		if start < 0:
+			return rules
+		depth, end = 1, start + 1
+		while depth:
+			depth += {'{': 1, '}': -1}.get(css[end], 0)
+			end += 1
+		prelude, body = ' '.join(css[position:start].split()), css[start + 1:end - 1]
+		rules.append((prelude, parse_css(body) if prelude.startswith(('@media', '@supports')) else ' '.join(body.split())))
+		position = end
+
+class ElementCollector(HTMLParser):
+	def __init__(self):
+		super().__init__()
+		self.elements = set() # (tag, ids, classes)
+
+	def handle_starttag(self, tag, attrs):
+		attrs = dict(attrs)
+		self.elements.add((tag, frozenset((attrs.get('id') or '').split()), frozenset((attrs.get('class') or '').split())))
+
+def above_the_fold(html):
+	# the header and the first section of <main>, or all of <main> on pages without sections
+	main = html.find('<main')
+	end = html.find('</section>', main) if main >= 0 else -1
+	if end < 0:
+		end = html.find('</main>')
+	return html if end < 0 else html[:end]
+
+def selector_matches(selector, elements):
+	for compound in css_combinator_pattern.split(css_pseudo_pattern.sub('', selector).strip()):
+		tag, ids, classes = None, set(), set()
+		for prefix, name in css_compound_pattern.findall(compound):
+			if prefix == '#':
+				ids.add(name)
+			elif prefix == '.':
+				classes.add(name)
+			else:
+				tag = name.lower()
+		if not any((tag is None or element_tag == tag) and ids <= element_ids and classes <= element_classes for element_tag, element_ids, element_classes in elements):
+			return False
+	return True
+
+def critical_rules(rules, elements):
+	kept = []
+	for prelude, body in rules:
+		if isinstance(body, list):
+			body = critical_rules(body, elements)
+			if body:
+				kept.append(f"{prelude}{{{''.join(body)}}}")
+		elif not prelude.startswith('@'):
+			selectors = [selector for selector in prelude.split(',') if selector_matches(selector, elements)]
+			if selectors:
+				kept.append(f"{','.join(selector.strip() for selector in selectors)}{{{body}}}")
+	return kept
+
+def critical_stylesheet(css, elements):
+	rules = parse_css(css_comment_pattern.sub('', css))
+	kept = ''.join(critical_rules(rules, elements))
+	# @keyframes (and any other at-rule) only when a kept rule names it
+	for prelude, body in rules:
+		if prelude.startswith('@keyframes') and re.search(rf'\b{re.escape(prelude.split()[-1])}\b', kept):
+			kept += f"{prelude}{{{body}}}"
+	return kept
+
+def load_critical_manifest():
+	try:
+		with open(critical_css_file) as handler:
+			return json.load(handler)
+	except FileNotFoundError:
+		return {}
+
+critical_manifest = load_critical_manifest()
+
+@app.template_global()
+@pass_context
+def critical_css(context):
+	# rules for the template being rendered, as long as they were cut from the cryo.css that is being served
+	if not app.config['CRITICAL_CSS'] or critical_manifest.get('stylesheet') != asset_manifest.hashed.get('cryo.css'):
+		return None
+	css = critical_manifest.get('templates', {}).get(context.name)
+	return Markup(css) if css else None
+
+def blocking_bytes(html):
+	# local stylesheets and inline styles in <head>, the bytes the browser needs before it can paint
+	head = re.sub(r'<noscript>.*?</noscript>', '', html[:html.find('</head>')], flags=re.S)
+	total = sum(len(style.encode()) for style in re.findall(r'<style[^>]*>(.*?)</style>', head, re.S))
+	for href in re.findall(r'<link rel="stylesheet" href="/static/([^"]+)"', head):
+		filename = asset_manifest.originals.get(href, href)
+		if os.path.isfile(os.path.join(app.static_folder, filename)):
+			total += os.path.getsize(os.path.join(app.static_folder, filename))
+	return total
+
+@app.cli.command('critical-css')
+def critical_css_command():
+	"""Record the above the fold rules of cryo.css for every template and report the render blocking bytes per route."""
+	global critical_manifest
+	client = app.test_client()
+	# crawling every route is not a visit
+	app.config['COUNTERS'] = False
+	with app.test_request_context():
+		stylesheet_url = url_for('static', filename='cryo.css')
+	rendered = []
+	def record(sender, template, context, **extra):
+		rendered.append(template.name)
+	app.config['CRITICAL_CSS'] = False
+	elements, before, templates = defaultdict(set), {}, {}
+	with before_render_template.connected_to(record, app):
+		for url in page_urls():
+			del rendered[:]
+			response = client.get(url)
+			html = response.get_data(as_text=True)
+			if response.status_code != 200 or response.mimetype != 'text/html' or stylesheet_url not in html:
+				continue
+			collector = ElementCollector()
+			collector.feed(above_the_fold(html))
+			templates[url] = rendered[0]
+			elements[rendered[0]] |= collector.elements
+			before[url] = blocking_bytes(html)
+	with open(os.path.join(app.static_folder, 'cryo.css'), encoding='utf-8') as handler:
+		stylesheet = handler.read()
+	critical_manifest = dict(stylesheet=asset_manifest.hashed['cryo.css'], templates={name: critical_stylesheet(stylesheet, found) for name, found in sorted(elements.items())})
+	os.makedirs(os.path.dirname(critical_css_file), exist_ok=True)
+	with open(critical_css_file + '.tmp', 'w') as handler:
+		json.dump(critical_manifest, handler, indent=1)
+	os.replace(critical_css_file + '.tmp', critical_css_file)
+	app.config['CRITICAL_CSS'] = True
+	click.echo(f"{'route':<48} {'template':<40} {'before KB':>10} {'after KB':>10}")
+	for url, name in templates.items():
+		after = blocking_bytes(client.get(url).get_data(as_text=True))
+		click.echo(f"{url:<48} {name:<40} {before[url] / 1024:>10.1f} {after / 1024:>10.1f}")
+	click.echo(f"{len(critical_manifest['templates'])} templates, {len(stylesheet.encode()) / 1024:.1f} KB cryo.css")
 
 
 #[Routes]===============================================================================================================
@@ -36,8 +2117,13 @@ def redirect_to_home():
 
 @app.route('/home')
 def home():
-	posts = sorted(pages, key=lambda p: p.meta.get('date'), reverse=True)
-	docnum = len([f for f in os.listdir(docsdir)])
+	cursor = None
+	if request.args.get('cursor'):
+		cursor = decode_cursor(request.args['cursor'])
+		if cursor is None:
+			abort(400)
+	posts, next_cursor = post_index.page(cursor, app.config['POSTS_PER_PAGE'])
+	docnum = document_catalog.count()
 	subjects = {
 	"biology" : "Topics based on general biology as well as grade 12 biology can be learnt from here.[Grade 12]",
 	"cybersecurity" : "Topics based on cybersecurity, from school to college level or even masters can be learnt from here.[Basics]",
@@ -48,20 +2134,148 @@ def home():
 	}
 	subject_count = len(subjects) + len(anadomains)
 	crt_time = datetime.now()
-	return render_template('index.html', time=crt_time, subjects=subjects, posts=posts, subject_count=subject_count, docnum=docnum, anadomains=anadomains)
+	# stream so the header and hero section go out before the rest of the page is rendered
+	return Response(stream_template('index.html', time=crt_time, subjects=subjects, posts=posts, next_cursor=next_cursor, subject_count=subject_count, docnum=docnum, anadomains=anadomains))
+
+@app.route('/api/posts')
+def posts_api():
+	cursor = None
+	if request.args.get('cursor'):
+		cursor = decode_cursor(request.args['cursor'])
+		if cursor is None:
+			abort(400)
+	limit = min(request.args.get('limit', app.config['POSTS_PER_PAGE'], type=int), max(app.config['POSTS_PER_PAGE'], 100))
+	posts, next_cursor = post_index.page(cursor, max(limit, 1))
+	return jsonify(
+		posts=[post_json(post) for post in posts],
+		next=next_cursor,
+	)
 
 @app.route('/ideas/<path:path>')
 def idea_page(path):
-    page = pages.get_or_404(path)
-    return render_template('page.html', page=page)
+	entry = page_cache.lookup(path)
+	if entry is None:
+		abort(404)
+	mtime, etag, _ = entry
+	if request.method == 'GET':
+		counters.increment('view', path)
+	last_modified = datetime.fromtimestamp(mtime / 1e9, timezone.utc)
+	return conditional_response(etag, last_modified, lambda: page_cache.render(path, lambda: render_template('page.html', page=post_index.page_for(path))))
+
+@app.route('/feed.xml')
+def feed():
+	document = feed_document.get()
+	return conditional_response(document.etag, document.last_modified, lambda: document.body, mimetype='application/atom+xml')
+
+@app.route('/sitemap.xml')
+def sitemap():
+	document = sitemap_document.get()
+	return conditional_response(document.etag, document.last_modified, lambda: document.body, mimetype='application/xml')
+
+@app.route('/search')
+def search():
+	query = request.args.get('q', '').strip()
+	results = search_index.search(query) if query else []
+	return render_template('search.html', query=query, results=results)
+
+@app.route('/api/search')
+def search_api():
+	results = search_index.search(request.args.get('q', ''), limit=min(request.args.get('limit', 20, type=int), 100))
+	return jsonify(results=[post_json(post) for post in results])
 
 @app.route('/dochub')
 def dochub():
 	return render_template('documents/index.html')
 
+def document_json(document):
+	info = document_catalog.info.get(document.filename, {})
+	return dict(filename=document.filename, title=document.title, tags=list(document.tags), size=document.size, pages=info.get('pages'), pdf_title=info.get('title'), author=info.get('author'), downloads=counters.counts('download')[document.filename], url=document_url(document.filename))
+
+@app.route('/dochub/api/documents')
+def documents_api():
+	tags = [tag.strip() for tag in request.args.get('tags', '').split(',') if tag.strip()]
+	page = max(request.args.get('page', 1, type=int), 1)
+	per_page = app.config['DOCUMENTS_PER_PAGE']
+	filenames = document_catalog.filenames(*tags)
+	if request.args.get('sort') == 'popular':
+		filenames = by_popularity(filenames)
+	documents = [document_catalog.by_filename[filename] for filename in filenames[(page - 1) * per_page:page * per_page]]
+	return jsonify(
+		tags=tags,
+		page=page,
+		pages=max(-(-len(filenames) // per_page), 1),
+		total=len(filenames),
+		facets=document_catalog.facets(*tags),
+		documents=[document_json(document) for document in documents],
+	)
+
+@app.route('/dochub/search')
+def document_search_page():
+	query = request.args.get('q', '').strip()
+	results = []
+	for filename, pages in document_search.search(query) if query else []:
+		document = document_catalog.by_filename.get(filename)
+		if document is not None:
+			results.append((document, pages))
+	return render_template('documents/search.html', query=query, results=results)
+
+@app.route('/dochub/api/search')
+def document_search_api():
+	results = []
+	for filename, pages in document_search.search(request.args.get('q', ''), limit=min(request.args.get('limit', 20, type=int), 100)):
+		document = document_catalog.by_filename.get(filename)
+		if document is not None:
+			results.append(dict(document_json(document), pages=pages, page_urls=[document_url(filename, inline=1) + f"#page={number}" for number in pages]))
+	return jsonify(results=results)
+
+@app.route('/dochub/bundle')
+@download_limited
+def document_bundle():
+	tags = sorted({tag.strip() for tag in request.args.get('tags', '').split(',') if tag.strip()})
+	documents = [document_catalog.by_filename[filename] for filename in document_catalog.filenames(*tags)]
+	if not tags or not documents:
+		abort(404)
+	# the zip headers carry the mtimes, so a touched file is a different bundle too
+	etag = hashlib.sha256(' '.join(f"{document.filename}/{document_catalog.digest(document.filename)}/{document.mtime}" for document in documents).encode()).hexdigest()
+	if not is_resource_modified(request.environ, etag=etag):
+		response = Response(status=304)
+	else:
+		# no zip64, so every size and offset has to fit in 32 bits, checked before any header is packed
+		if zip_length(documents) > 0xffffffff or len(documents) > 0xffff:
+			abort(413)
+		parts, length = zip_parts(documents)
+		if app.config['DOCUMENT_OFFLOAD_HEADER']:
+			response = offload_response(parts, length, mimetype='application/zip')
+		else:
+			response = Response(iter_parts(parts), mimetype='application/zip', direct_passthrough=True)
+			response.content_length = length
+		response.headers.set('Content-Disposition', 'attachment', filename=f"dochub-{'-'.join(tags)}.zip")
+		g.download = ('bundle', ','.join(tags))
+	response.set_etag(etag)
+	response.cache_control.public = True
+	response.cache_control.max_age = app.config['DOCUMENT_MAX_AGE']
+	return response
+
+@app.route('/dochub/blob/<digest>/<path:name>')
+@download_limited
+def document_blob(digest, name):
+	filename = document_catalog.blob(digest, name)
+	if filename is None:
+		abort(404)
+	# ?inline=1 opens the pdf in the browser, used by search results to jump to a page
+	g.download = ('download', filename)
+	return send_document(document_catalog.by_filename[filename], as_attachment=not request.args.get('inline'), immutable=True)
+
 @app.route('/dochub/<path:filename>')
 def download_file(filename):
-	return send_from_directory('static/documents', filename, as_attachment=True)
+	document = document_catalog.get().by_filename.get(filename)
+	if document is None:
+		abort(404)
+	# names are mutable, so only the redirect is revalidated and the content is cached under its hash for good
+	digest = document_catalog.digest(filename)
+	response = redirect(url_for('document_blob', digest=digest, name=document_catalog.blob(digest), inline=request.args.get('inline')))
+	response.cache_control.no_cache = True
+	return response
 
 @app.route('/subjects/<subject>')
 def route_subject(subject):
@@ -73,7 +2287,7 @@ def route_analytical_domain(anadomain):
 
 @app.route('/subjects/biology')
 def biology():
-	docnum = len([f for f in os.listdir(docsdir) if "[bio]" in f])
+	docnum = document_catalog.count('bio')
 	topics = {
 	"organisms_and_populations" : "This topic is about how different organisms interact with each other in a population, the factors affecting it and study of ecology. Different organisms interact with each other differently. Population growth and the ecosystem, though are very large, these are all small worlds. Think about how diseases spread through different populations. Will they spread more in big population or in a small population? Which population will be fully infected if the infection started in the same time for both the big and small population? Read this lesson to learn more.[Ecology]",
 	"molecular_basis_of_inheritance" : "How do organisms grow? Where are these informations stored? What is inheritance? Does your parents give you some sort of information for your growth? Have you ever wondered when someone says 'You look like your grandmother.'? Everything is routed in molecular biology, your cells and DNA. Explore this chapter to know more. [Biotechnology]",
@@ -92,7 +2306,7 @@ def cybersecurity():
 
 @app.route('/analytical_domains/sec-reports')
 def sec_reports():
-	docnum = len([f for f in os.listdir(docsdir) if "[secreport]" in f])
+	docnum = document_catalog.count('secreport')
 	topics = {
 	}
 	topic_count = len(topics)
@@ -100,7 +2314,7 @@ def sec_reports():
 
 @app.route('/analytical_domains/scene-scape')
 def scene_scape():
-	docnum = len([f for f in os.listdir(docsdir) if "[scenescape]" in f])
+	docnum = document_catalog.count('scenescape')
 	topics = {
 	"rabrid-x133" : "An accidental global biowar scenario involving a genetically engineered rabies-like virus, set in a multipolar conflit. Rabies with only 12000 base pairs of genes is abundant in natural reserviors like dogs and other racoon like species, has -ssRNA. With advancing biotechnological and AI integration, the chances of mutating it is very high.[Hypothetical Scenario]",
 	}
@@ -153,28 +2367,28 @@ def nmap():
 
 @app.route('/dochub/biodoc')
 def biodoc():
-	unacademydocs = [f for f in os.listdir(docsdir) if "[bio]" and "[unacademy]" in f]
-	qbdocs = [f for f in os.listdir(docsdir) if "[bio]" and "[qb]" in f]
-	gendocs = [f for f in os.listdir(docsdir) if "[bio]" and "[gen]" in f]
+	unacademydocs = document_catalog.filenames('bio', 'unacademy')
+	qbdocs = document_catalog.filenames('bio', 'qb')
+	gendocs = document_catalog.filenames('bio', 'gen')
 	doccount = len(unacademydocs) + len(qbdocs) + len(gendocs)
 	return render_template('documents/biodoc.html',unacademydocs=unacademydocs, qbdocs=qbdocs, gendocs=gendocs)
 
 @app.route('/dochub/compdoc')
 def compdoc():
-	netdocs = [f for f in os.listdir(docsdir) if "[comp]" and "[net]" in f] #Networking
-	hackdocs = [f for f in os.listdir(docsdir) if "[comp]" and "[hack]" in f] #Hacking
-	pydocs = [f for f in os.listdir(docsdir) if "[comp]" and "[pydoc]" in f] #Python documents and documentations
-	gendocs = [f for f in os.listdir(docsdir) if "[comp]" and "[gen]" in f] # general documents
-	cdocs = [f for f in os.listdir(docsdir) if "[comp]" and "[cdoc]" in f] #C and C++ language documents
-	jsdocs = [f for f in os.listdir(docsdir) if "[comp]" and "[jsdoc]" in f] #Javascript documents
-	javadocs = [f for f in os.listdir(docsdir) if "[comp]" and "[javadoc]" in f] # javadocuments
-	fsdocs = [f for f in os.listdir(docsdir) if "[comp]" and "[fsdoc]" in f] #file systems and os documents
-	doccount = len([f for f in os.listdir(docsdir) if "[comp]" in f])
+	netdocs = document_catalog.filenames('comp', 'net') #Networking
+	hackdocs = document_catalog.filenames('comp', 'hack') #Hacking
+	pydocs = document_catalog.filenames('comp', 'pydoc') #Python documents and documentations
+	gendocs = document_catalog.filenames('comp', 'gen') # general documents
+	cdocs = document_catalog.filenames('comp', 'cdoc') #C and C++ language documents
+	jsdocs = document_catalog.filenames('comp', 'jsdoc') #Javascript documents
+	javadocs = document_catalog.filenames('comp', 'javadoc') # javadocuments
+	fsdocs = document_catalog.filenames('comp', 'fsdoc') #file systems and os documents
+	doccount = document_catalog.count('comp')
 	return render_template('documents/compdoc.html', netdocs=netdocs, hackdocs=hackdocs, pydocs=pydocs, gendocs=gendocs, cdocs=cdocs, jsdocs=jsdocs, javadocs=javadocs, fsdocs=fsdocs)
 
 @app.route('/dochub/weapdoc')
 def weapdoc():
-	docs = [f for f in os.listdir(docsdir) if "[weap]" in f]
+	docs = document_catalog.filenames('weap')
 	return render_template('documents/weapdoc.html', docs=docs)
 
 @app.route('/websites')
@@ -189,7 +2403,182 @@ def courses():
 def codes():
 	return render_template('comming_soon.html', title="My Codes", pgdesc="Welcome to my codes. Here you can find all of my codes. Soon I will post them all.")
 
+@app.route('/stats/highlight')
+def highlight_stats():
+	return jsonify(highlight_cache.stats())
+
+
+#[Warmup]===============================================================================================================
+# Render the markdown of every post across a process pool before serving, enabled with WARMUP_PAGES=1
+# gunicorn runs it from post_worker_init in gunicorn.conf.py
+
+def render_markdown(path):
+	start = time.perf_counter()
+	html = markdown.markdown(post_index.page_for(path).body, extensions=app.config['FLATPAGES_MARKDOWN_EXTENSIONS'], extension_configs=app.config['FLATPAGES_MARKDOWN_EXTENSION_CONFIGS'])
+	return path, html, time.perf_counter() - start
+
+def warmup():
+	paths = [post.path for post in post_index.get()]
+	timings = []
+	with process_pool(len(paths)) as executor, app.test_request_context():
+		for path, html, elapsed in executor.map(render_markdown, paths):
+			# prime the page's cached html and the rendered page cache
+			page = post_index.page_for(path)
+			page.__dict__['html'] = html
+			page_cache.render(path, lambda: render_template('page.html', page=page))
+			timings.append((elapsed, path))
+	timings.sort(reverse=True)
+	return timings
+
+@app.cli.command('warmup')
+def warmup_command():
+	"""Render all posts in parallel and report the markdown time per page."""
+	for elapsed, path in warmup():
+		click.echo(f"{elapsed * 1000:10.1f} ms  {path}")
+
+def log_warmup():
+	# must run after the module has finished importing, the pool workers unpickle functions from it
+	if os.environ.get("WARMUP_PAGES") == "1":
+		for elapsed, path in warmup():
+			app.logger.warning("warmup %.1f ms %s", elapsed * 1000, path)
+
+
+#[Freeze]===============================================================================================================
+# Export every route that is a pure function of files on disk to a static tree, run with : flask --app app freeze build
+
+compressible_types = ('text/', 'application/javascript', 'application/json', 'application/xml', 'application/atom+xml', 'image/svg+xml')
+
+def is_compressible(mimetype):
+	return mimetype is not None and mimetype.startswith(compressible_types)
+
+def precompress(filename, body):
+	with open(filename + '.gz', 'wb') as handler:
+		handler.write(gzip.compress(body, compresslevel=9, mtime=0))
+	if brotli is not None:
+		with open(filename + '.br', 'wb') as handler:
+			handler.write(brotli.compress(body, quality=11))
+
+def page_urls():
+	with app.test_request_context():
+		for rule in app.url_map.iter_rules():
+			if rule.endpoint != 'static' and 'GET' in rule.methods and not rule.arguments:
+				yield url_for(rule.endpoint)
+		for post in post_index.get():
+			yield url_for('idea_page', path=post.path)
+
+def freeze_urls():
+	yield from page_urls()
+	with app.test_request_context():
+		for filename in document_catalog.filenames():
+			yield url_for('download_file', filename=filename)
+			yield document_url(filename)
+
+@app.cli.command('dedupe-documents')
+def dedupe_documents_command():
+	"""Replace documents identical to an earlier one with hard links to it."""
+	saved = 0
+	for filename in document_catalog.filenames():
+		original = document_catalog.blob(document_catalog.digest(filename))
+		path, original_path = document_catalog.path(filename), document_catalog.path(original)
+		if original != filename and not os.path.samefile(path, original_path):
+			tmpname = f"{path}.{os.getpid()}.tmp"
+			os.link(original_path, tmpname)
+			os.replace(tmpname, path)
+			saved += document_catalog.by_filename[filename].size
+			click.echo(f"{filename} -> {original}")
+	click.echo(f"{saved / (1 << 20):.1f} MB saved")
+
+@app.cli.command('compress-static')
+def compress_static():
+	"""Write .gz/.br siblings of the static css, js, html, json, svg and font files for the static route to send."""
+	if brotli is None:
+		click.echo("brotli is not installed, skipping .br variants")
+	for filename, _ in asset_manifest.hashed.items():
+		path = os.path.join(app.static_folder, filename)
+		if not is_static_compressible(mimetypes.guess_type(filename)[0]):
+			# siblings written before the type was left out
+			for _, suffix in static_encodings:
+				if os.path.isfile(path + suffix):
+					os.remove(path + suffix)
+			continue
+		stat = os.stat(path)
+		if all(os.path.isfile(path + suffix) and os.stat(path + suffix).st_mtime_ns == stat.st_mtime_ns for _, suffix in static_encodings if suffix != '.br' or brotli is not None):
+			continue
+		with open(path, 'rb') as handler:
+			body = handler.read()
+		precompress(path, body)
+		sizes = []
+		for _, suffix in static_encodings:
+			if os.path.isfile(path + suffix):
+				os.utime(path + suffix, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+				sizes.append(f"{suffix} {os.path.getsize(path + suffix) / 1024:.1f} KB")
+		click.echo(f"{filename} {len(body) / 1024:.1f} KB -> {', '.join(sizes)}")
+
+@app.cli.command('build')
+@click.pass_context
+def build_command(context):
+	"""Generate every derived static file, run once at deploy time so the server never builds or fetches on boot."""
+	context.invoke(vendor_assets_command)
+	context.invoke(build_images)
+	# the fingerprints were taken at import, before the new files existed
+	asset_manifest.build()
+	context.invoke(critical_css_command)
+	context.invoke(compress_static)
+
+@app.cli.command('freeze')
+@click.argument('outdir', default='build')
+def freeze(outdir):
+	"""Pre-render all routes and static files to OUTDIR with .gz/.br siblings."""
+	if brotli is None:
+		click.echo("brotli is not installed, skipping .br variants")
+	client = app.test_client()
+	app.config['DOWNLOAD_LIMITS'] = False
+	app.config['COUNTERS'] = False
+	# a static host ignores ?cursor=, so the home page and /api/posts list every post on one page without load more
+	app.config['POSTS_PER_PAGE'] = max(len(post_index.get()), 1)
+	# hash every document first so the pages link to the content addressed urls
+	for filename in document_catalog.filenames():
+		document_catalog.digest(filename)
+	for url in freeze_urls():
+		response = client.get(url)
+		if response.status_code in (301, 302, 303, 307, 308):
+			location = response.headers['Location']
+			body = f'<!DOCTYPE html><meta http-equiv="refresh" content="0; url={location}"><link rel="canonical" href="{location}">'.encode()
+			mimetype = 'text/html'
+		elif response.status_code == 200:
+			body = response.get_data()
+			mimetype = response.mimetype
+		else:
+			click.echo(f"{response.status_code} {url} skipped")
+			continue
+		path = unquote(urlsplit(url).path).strip('/')
+		if mimetype == 'text/html':
+			path = os.path.join(path, 'index.html')
+		target = os.path.join(outdir, path)
+		os.makedirs(os.path.dirname(target), exist_ok=True)
+		with open(target, 'wb') as handler:
+			handler.write(body)
+		if is_compressible(mimetype):
+			precompress(target, body)
+		click.echo(f"{response.status_code} {url} -> {target}")
+	# static files are copied as they are and compressed next to the originals. Documents were already written under
+	# their blob urls above and nothing links to static/documents, so they are not copied a second time
+	staticdir = os.path.join(outdir, app.static_url_path.strip('/'))
+	skipped = os.path.normpath(docsdir)
+	shutil.copytree(app.static_folder, staticdir, ignore=lambda directory, names: [name for name in names if os.path.normpath(os.path.join(directory, name)) == skipped], dirs_exist_ok=True)
+	# the pages link to the fingerprinted names
+	for filename, hashed in asset_manifest.hashed.items():
+		shutil.copy2(os.path.join(staticdir, filename), os.path.join(staticdir, hashed))
+	for cur_path, _, filenames in os.walk(staticdir):
+		for name in filenames:
+			filename = os.path.join(cur_path, name)
+			if not name.endswith(('.gz', '.br')) and is_static_compressible(mimetypes.guess_type(name)[0]):
+				with open(filename, 'rb') as handler:
+					precompress(filename, handler.read())
+
+
 if __name__ == "__main__":
+	log_warmup()
 	app.run(host="0.0.0.0", port=port)
 
 
@@ -0,0 +1,174 @@
+#[ASGI]=================================================================================================================
+# Evented front end for the Flask app. Flask runs each request on a thread of its own, but document bodies are
+# streamed from here on the event loop, so slow downloads cost a coroutine instead of a whole worker
+# Run with : gunicorn asgi:application -k uvicorn_worker.UvicornWorker
+
+from asgiref.wsgi import WsgiToAsgiInstance
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+import threading
+import asyncio
+import base64
+import json
+import os
+
+from app import app, download_limiter
+
+offload_header = b'x-offload-parts'
+release_header = b'x-offload-release'
+chunk_size = 1 << 16
+# flask threads per worker, and body chunks a response may have in flight before its thread waits for the loop
+threads = int(os.environ.get("WSGI_THREADS", 8))
+window = 64
+
+app.config['DOCUMENT_OFFLOAD_HEADER'] = offload_header.decode()
+app.config['DOCUMENT_RELEASE_HEADER'] = release_header.decode()
+
+class ThreadedWsgi:
+	# asgiref runs every request on one shared thread, so a slow one holds up the rest. Here each request gets a thread
+	# of its own pool, and body chunks are handed to the loop as they come, only joined when the loop is behind
+	def __init__(self, application, threads):
+		self.application = application
+		self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='flask')
+
+	async def __call__(self, scope, receive, send):
+		loop = asyncio.get_running_loop()
+		# environ and start_response are asgiref's
+		instance = WsgiToAsgiInstance(self.application)
+		instance.scope = scope
+		chunks = asyncio.Queue()
+		credit = threading.Semaphore(window)
+		stopped = threading.Event()
+
+		def run(body):
+			try:
+				result = self.application(instance.build_environ(scope, body), instance.start_response)
+				try:
+					for chunk in result:
+						if not chunk:
+							continue
+						credit.acquire()
+						if stopped.is_set():
+							break
+						loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+				finally:
+					if hasattr(result, 'close'):
+						result.close()
+			finally:
+				loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+		with SpooledTemporaryFile(max_size=chunk_size) as body:
+			while True:
+				message = await receive()
+				body.write(message.get('body', b''))
+				if not message.get('more_body'):
+					break
+			body.seek(0)
+			future = loop.run_in_executor(self.executor, run, body)
+			started, done = False, False
+			try:
+				while not done:
+					parts = [await chunks.get()]
+					while not chunks.empty():
+						parts.append(chunks.get_nowait())
+					if parts[-1] is None:
+						parts.pop()
+						done = True
+					if parts:
+						credit.release(len(parts))
+					if done:
+						# an exception from the app is raised here, before anything half baked is sent
+						await future
+					if not started:
+						started = True
+						await send(instance.response_start)
+					if parts:
+						await send({'type': 'http.response.body', 'body': b''.join(parts), 'more_body': True})
+				await send({'type': 'http.response.body', 'body': b''})
+			finally:
+				# the client went away or sending failed, let the thread run out instead of waiting on credit
+				stopped.set()
+				credit.release(window)
+				future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+flask_application = ThreadedWsgi(app, threads)
+
+async def stream_parts(receive, send, parts):
+	loop = asyncio.get_running_loop()
+	# the request body is already consumed, so the next message is the client going away
+	disconnect = asyncio.ensure_future(receive())
+	try:
+		for part in parts:
+			if disconnect.done():
+				break
+			if 'data' in part:
+				await send({'type': 'http.response.body', 'body': base64.b64decode(part['data']), 'more_body': True})
+				continue
+			handler = await loop.run_in_executor(None, open, part['path'], 'rb')
+			try:
+				handler.seek(part['offset'])
+				length = part['length']
+				while length > 0 and not disconnect.done():
+					chunk = await loop.run_in_executor(None, handler.read, min(chunk_size, length))
+					if not chunk:
+						# the file shrank under us, the client can only be told by closing the connection early
+						raise OSError(f"{part['path']} ended {length} bytes early")
+					length -= len(chunk)
+					# uvicorn waits for a paused transport to drain, so a slow client just parks this coroutine
+					await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+			finally:
+				handler.close()
+		await send({'type': 'http.response.body', 'body': b''})
+	finally:
+		disconnect.cancel()
+
+async def lifespan(receive, send):
+	# nothing to set up, the app is ready once imported. On shutdown the running requests finish first
+	while True:
+		message = await receive()
+		if message['type'] == 'lifespan.startup':
+			await send({'type': 'lifespan.startup.complete'})
+		elif message['type'] == 'lifespan.shutdown':
+			await asyncio.get_running_loop().run_in_executor(None, flask_application.executor.shutdown)
+			await send({'type': 'lifespan.shutdown.complete'})
+			return
+
+async def application(scope, receive, send):
+	if scope['type'] == 'lifespan':
+		return await lifespan(receive, send)
+	if scope['type'] == 'websocket':
+		# flask has no websocket routes, closing before accepting makes the server answer 403
+		await receive()
+		return await send({'type': 'websocket.close'})
+	if scope['type'] != 'http':
+		raise ValueError(f"unsupported scope type {scope['type']}")
+	manifest = None
+	release = None
+
+	async def intercept(message):
+		# the flask thread waits on every send, so only collect the manifest here and send the parts once flask is done
+		nonlocal manifest, release
+		if message['type'] == 'http.response.start':
+			headers = message.get('headers', [])
+			length = next((value for name, value in headers if name.lower() == offload_header), None)
+			if length is not None:
+				manifest = []
+				release = next((value.decode() for name, value in headers if name.lower() == release_header), None)
+				headers = [(name, length if name.lower() == b'content-length' else value) for name, value in headers if name.lower() not in (offload_header, release_header)]
+			message = dict(message, headers=headers)
+		elif manifest is not None:
+			manifest.append(message.get('body', b''))
+			return
+		await send(message)
+
+	await flask_application(scope, receive, intercept)
+	if manifest is None:
+		return
+	try:
+		if scope['method'] == 'HEAD':
+			await send({'type': 'http.response.body', 'body': b''})
+		else:
+			await stream_parts(receive, send, json.loads(b''.join(manifest)))
+	finally:
+		if release is not None:
+			await asyncio.get_running_loop().run_in_executor(None, download_limiter.release, int(release))
@@ -0,0 +1,71 @@
+#[Benchmark]============================================================================================================
+# Compare document download throughput of the old send_from_directory path against send_document
+# Run with : python bench_downloads.py [requests] [concurrency]
+
+from flask import send_from_directory
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import http.client
+import subprocess
+import sys
+import time
+import os
+
+from app import app, document_catalog
+
+port = 8765
+
+# the download route as it was before send_document, kept here only to measure against
+@app.route('/bench/legacy/<path:filename>')
+def legacy_download(filename):
+	return send_from_directory('static/documents', filename, as_attachment=True)
+
+def fetch(url, headers):
+	connection = http.client.HTTPConnection('127.0.0.1', port)
+	connection.request('GET', url, headers=headers)
+	response = connection.getresponse()
+	received = 0
+	while True:
+		chunk = response.read(1 << 16)
+		if not chunk:
+			break
+		received += len(chunk)
+	connection.close()
+	return received
+
+def run(paths, requests, concurrency, headers):
+	urls = [paths[i % len(paths)] for i in range(requests)]
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		received = sum(executor.map(lambda url: fetch(url, headers), urls))
+	elapsed = time.perf_counter() - start
+	return received / elapsed / (1 << 20), requests / elapsed
+
+def wait_for_server():
+	for _ in range(100):
+		try:
+			http.client.HTTPConnection('127.0.0.1', port, timeout=1).request('HEAD', '/dochub')
+			return
+		except OSError:
+			time.sleep(0.1)
+	raise RuntimeError("gunicorn did not start")
+
+if __name__ == "__main__":
+	requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+	filenames = document_catalog.filenames()
+	# /dochub/<filename> only redirects now, the content addressed url is what browsers end up fetching
+	legacy = ['/bench/legacy/' + quote(filename) for filename in filenames]
+	blobs = [f"/dochub/blob/{document_catalog.digest(filename)}/{quote(filename)}" for filename in filenames]
+	server = subprocess.Popen(['gunicorn', 'bench_downloads:app', '-b', f'127.0.0.1:{port}', '-w', '2', '--log-level', 'warning'], cwd=os.path.dirname(os.path.abspath(__file__)))
+	try:
+		wait_for_server()
+		print(f"{requests} requests, {concurrency} concurrent, {len(filenames)} documents")
+		print(f"{'path':<10} {'request':<14} {'MB/s':>10} {'req/s':>10}")
+		for label, paths in (('legacy', legacy), ('sendfile', blobs)):
+			for kind, headers in (('full', {}), ('resume 1MB-', {'Range': 'bytes=1048576-'})):
+				throughput, rate = run(paths, requests, concurrency, headers)
+				print(f"{label:<10} {kind:<14} {throughput:>10.1f} {rate:>10.1f}")
+	finally:
+		server.terminate()
+		server.wait()
@@ -0,0 +1,100 @@
+#[Benchmark]============================================================================================================
+# Home page latency while slow clients download documents, with sync gunicorn workers and with the asgi front end
+# Run with : python bench_slow_downloads.py [slow clients] [seconds]
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import http.client
+import statistics
+import subprocess
+import threading
+import socket
+import sys
+import time
+import os
+
+from app import document_catalog
+
+port = 8766
+servers = {
+	'sync': ['gunicorn', 'app:app'],
+	'asgi': ['gunicorn', 'asgi:application', '-k', 'uvicorn_worker.UvicornWorker'],
+}
+
+def slow_download(path, stop, rate=64 << 10, chunk=4096):
+	# a client on a bad link: tiny receive window, reads about rate bytes per second until stopped
+	connection = socket.create_connection(('127.0.0.1', port))
+	connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, chunk)
+	connection.sendall(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode())
+	try:
+		while not stop.is_set() and connection.recv(chunk):
+			time.sleep(chunk / rate)
+	except OSError:
+		pass
+	finally:
+		connection.close()
+
+def fetch_home():
+	start = time.perf_counter()
+	try:
+		connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+		connection.request('GET', '/home')
+		response = connection.getresponse()
+		response.read()
+		connection.close()
+		return (time.perf_counter() - start) * 1000 if response.status == 200 else None
+	except OSError:
+		return None
+
+def measure(seconds, concurrency=4):
+	latencies, failures = [], 0
+	deadline = time.perf_counter() + seconds
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		while time.perf_counter() < deadline:
+			for latency in executor.map(lambda _: fetch_home(), range(concurrency)):
+				if latency is None:
+					failures += 1
+				else:
+					latencies.append(latency)
+	return latencies, failures
+
+def wait_for_server():
+	for _ in range(100):
+		try:
+			connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+			connection.request('HEAD', '/dochub')
+			connection.getresponse()
+			return
+		except OSError:
+			time.sleep(0.1)
+	raise RuntimeError("gunicorn did not start")
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(int(len(values) * fraction), len(values) - 1)] if values else float('nan')
+
+if __name__ == "__main__":
+	clients = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+	seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+	document = max(document_catalog.documents, key=lambda document: document.size)
+	path = f"/dochub/blob/{document_catalog.digest(document.filename)}/{quote(document.filename)}"
+	print(f"{clients} slow clients on {document.filename} ({document.size / (1 << 20):.1f} MB), 2 workers, {seconds:.0f}s per run")
+	print(f"{'server':<6} {'downloads':<10} {'requests':>9} {'failed':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+	for name, command in servers.items():
+		server = subprocess.Popen(command + ['-b', f'127.0.0.1:{port}', '-w', '2', '--log-level', 'warning'], cwd=os.path.dirname(os.path.abspath(__file__)))
+		try:
+			wait_for_server()
+			for downloads in (0, clients):
+				stop = threading.Event()
+				threads = [threading.Thread(target=slow_download, args=(path, stop), daemon=True) for _ in range(downloads)]
+				for thread in threads:
+					thread.start()
+				time.sleep(1 if downloads else 0)
+				latencies, failures = measure(seconds)
+				stop.set()
+				for thread in threads:
+					thread.join()
+				print(f"{name:<6} {downloads:<10} {len(latencies):>9} {failures:>7} {statistics.median(latencies) if latencies else float('nan'):>9.1f} {percentile(latencies, 0.99):>9.1f} {max(latencies, default=float('nan')):>9.1f}")
+		finally:
+			server.terminate()
+			server.wait()
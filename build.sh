@@ -0,0 +1,6 @@
+#!/bin/bash
+# deploy build command, everything generated is made here so the workers never fetch or build on boot
+
+set -e
+pip install -r requirements.txt
+flask --app app build
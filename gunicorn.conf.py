@@ -0,0 +1,20 @@
+#[Gunicorn]=============================================================================================================
+# Settings picked up by gunicorn from the working directory
+
+import subprocess
+
+def on_starting(server):
+	# precompress static files once in the master, before any worker starts serving them. Only files changed since
+	# the deploy build are compressed, nothing is fetched, see build.sh
+	subprocess.run(['flask', '--app', 'app', 'compress-static'], check=False)
+
+def post_fork(server, worker):
+	# with preload_app the watcher threads were started in the master and did not survive the fork
+	if server.cfg.preload_app:
+		from app import watcher
+		watcher.restart()
+
+def post_worker_init(worker):
+	# the app is fully imported here, warm it up before the worker accepts traffic
+	from app import log_warmup
+	log_warmup()
@@ -185,6 +185,20 @@ document.addEventListener('DOMContentLoaded', function () {
     observer.observe(document.getElementById('skills'));
 
     // Theme toggle
+    // the header background is a <picture>, its sources win over img.src, so the whole element is swapped
+    function setHeaderBackground(theme) {
+        const current = document.getElementById("headerbg");
+        const template = document.getElementById("headerbg-" + theme);
+        if (!current) {
+            return;
+        }
+        if (template && current.parentElement.tagName === "PICTURE") {
+            current.parentElement.replaceWith(template.content.cloneNode(true));
+        } else {
+            current.src = "/static/img/header-bg-" + theme + ".png";
+        }
+    }
+
     const themeToggle = document.querySelector('.theme-toggle');
     const body = document.body;
 
@@ -192,11 +206,11 @@ document.addEventListener('DOMContentLoaded', function () {
         if (body.getAttribute('data-theme') === 'light') {
             body.removeAttribute('data-theme');
             themeToggle.innerHTML = '<i class="fas fa-moon"></i>';
-            document.getElementById("headerbg").src="/static/img/header-bg-dark.png";
+            setHeaderBackground('dark');
         } else {
             body.setAttribute('data-theme', 'light');
             themeToggle.innerHTML = '<i class="fas fa-sun"></i>';
-            document.getElementById("headerbg").src="/static/img/header-bg-light.png";
+            setHeaderBackground('light');
         }
     });
 
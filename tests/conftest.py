@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+# no inotify threads in tests, the catalogs and indexes poll instead
+os.environ.setdefault("WATCH_FILES", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as site
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+	# a catalog of a few small documents in place of static/documents
+	directory = tmp_path / 'documents'
+	directory.mkdir()
+	(directory / 'alpha[a].pdf').write_bytes(bytes(range(256)) * 40)
+	(directory / 'beta[a][b].txt').write_bytes(b'beta ' * 3000)
+	(directory / 'gamma é[b].txt').write_bytes(b'')
+	catalog = site.DocumentCatalog(str(directory), 0)
+	catalog.refresh()
+	monkeypatch.setattr(site, 'document_catalog', catalog)
+	monkeypatch.setitem(site.app.config, 'DOCUMENT_OFFLOAD_HEADER', None)
+	return catalog
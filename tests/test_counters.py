@@ -0,0 +1,23 @@
+import app as site
+
+
+def test_increments_stay_counted_across_a_flush(tmp_path):
+	counters = site.Counters(str(tmp_path / 'counters.sqlite3'), 3600)
+	counters.increment('download', 'x.pdf')
+	assert counters.top('download') == [('x.pdf', 1)]
+	counters.flush()
+	assert counters.top('download') == [('x.pdf', 1)]
+	counters.increment('download', 'x.pdf')
+	counters.increment('view', 'post')
+	assert counters.top('download') == [('x.pdf', 2)]
+	counters.flush()
+	assert counters.counts('download') == {'x.pdf': 2}
+	assert counters.counts('view') == {'post': 1}
+
+
+def test_counting_can_be_turned_off(tmp_path, monkeypatch):
+	counters = site.Counters(str(tmp_path / 'counters.sqlite3'), 3600)
+	monkeypatch.setitem(site.app.config, 'COUNTERS', False)
+	counters.increment('view', 'post')
+	assert not counters.pending
+	assert counters.thread is None
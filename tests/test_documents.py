@@ -0,0 +1,111 @@
+import io
+import zipfile
+import zlib
+from datetime import timedelta
+
+import pytest
+from werkzeug.http import http_date
+
+import app as site
+
+
+def body(response):
+	data = b''.join(response.response)
+	response.close()
+	return data
+
+
+def test_zip_parts_match_zipfile(catalog):
+	documents = catalog.documents
+	parts, length = site.zip_parts(documents)
+	data = b''.join(site.iter_parts(parts))
+	assert len(data) == length
+	archive = zipfile.ZipFile(io.BytesIO(data))
+	assert archive.testzip() is None
+	assert archive.namelist() == [document.filename for document in documents]
+	for document, info in zip(documents, archive.infolist()):
+		with open(catalog.path(document.filename), 'rb') as handler:
+			content = handler.read()
+		assert archive.read(info) == content
+		assert info.CRC == zlib.crc32(content)
+		assert info.compress_type == zipfile.ZIP_STORED
+		dostime, dosdate = site.dos_datetime(document.mtime)
+		assert info.date_time == ((dosdate >> 9) + 1980, dosdate >> 5 & 0xf, dosdate & 0x1f, dostime >> 11, dostime >> 5 & 0x3f, (dostime & 0x1f) * 2)
+
+
+def test_crc32_from_indexer(catalog):
+	filename = 'alpha[a].pdf'
+	info = site.extract_document(catalog.path(filename))
+	with open(catalog.path(filename), 'rb') as handler:
+		assert info['crc32'] == zlib.crc32(handler.read())
+
+
+def send(catalog, headers=None):
+	document = catalog.by_filename['alpha[a].pdf']
+	with site.app.test_request_context(headers=headers or {}):
+		response = site.send_document(document)
+		return response, body(response)
+
+
+@pytest.fixture
+def content(catalog):
+	with open(catalog.path('alpha[a].pdf'), 'rb') as handler:
+		return handler.read()
+
+
+def test_whole_document(catalog, content):
+	response, data = send(catalog)
+	assert response.status_code == 200
+	assert data == content
+	assert response.content_length == len(content)
+	assert response.headers['Accept-Ranges'] == 'bytes'
+
+
+# the document is 10240 bytes long
+@pytest.mark.parametrize('header, start, stop', [('bytes=0-99', 0, 100), ('bytes=100-', 100, 10240), ('bytes=-50', 10190, 10240), ('bytes=10000-20000', 10000, 10240)])
+def test_single_range(catalog, content, header, start, stop):
+	response, data = send(catalog, {'Range': header})
+	assert response.status_code == 206
+	assert data == content[start:stop]
+	assert response.headers['Content-Range'] == f"bytes {start}-{stop - 1}/10240"
+
+
+def test_several_ranges_get_whole_document(catalog, content):
+	response, data = send(catalog, {'Range': 'bytes=0-9,20-29'})
+	assert response.status_code == 200
+	assert data == content
+
+
+def test_unsatisfiable_range(catalog, content):
+	response, _ = send(catalog, {'Range': f"bytes={len(content)}-"})
+	assert response.status_code == 416
+	assert response.headers['Content-Range'] == f"bytes */{len(content)}"
+
+
+def test_if_range(catalog, content):
+	response, _ = send(catalog)
+	etag, last_modified = response.headers['ETag'], response.last_modified
+	assert send(catalog, {'Range': 'bytes=0-9', 'If-Range': etag})[0].status_code == 206
+	assert send(catalog, {'Range': 'bytes=0-9', 'If-Range': '"stale"'})[0].status_code == 200
+	assert send(catalog, {'Range': 'bytes=0-9', 'If-Range': http_date(last_modified)})[0].status_code == 206
+	newer = send(catalog, {'Range': 'bytes=0-9', 'If-Range': http_date(last_modified + timedelta(seconds=1))})
+	assert newer[0].status_code == 200
+	assert newer[1] == content
+
+
+def test_not_modified(catalog):
+	response, _ = send(catalog)
+	assert send(catalog, {'If-None-Match': response.headers['ETag']})[0].status_code == 304
+
+
+def test_zip_length_matches_parts(catalog):
+	assert site.zip_length(catalog.documents) == site.zip_parts(catalog.documents)[1]
+
+
+def test_oversized_bundle_is_refused(catalog, monkeypatch):
+	huge = catalog.by_filename['alpha[a].pdf']._replace(size=1 << 32)
+	monkeypatch.setitem(catalog.by_filename, 'alpha[a].pdf', huge)
+	monkeypatch.setattr(site.document_indexer, 'started', True)
+	monkeypatch.setitem(site.app.config, 'DOWNLOAD_LIMITS', False)
+	response = site.app.test_client().get('/dochub/bundle?tags=a')
+	assert response.status_code == 413
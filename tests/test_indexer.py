@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+
+import app as site
+
+pypdf = pytest.importorskip('pypdf')
+
+
+def write_pdf(path, pages, title):
+	writer = pypdf.PdfWriter()
+	for _ in range(pages):
+		writer.add_blank_page(width=200, height=200)
+	writer.add_metadata({'/Title': title, '/Author': 'Tester'})
+	with open(path, 'wb') as handler:
+		writer.write(handler)
+
+
+@pytest.fixture
+def directory(tmp_path):
+	directory = tmp_path / 'documents'
+	directory.mkdir()
+	write_pdf(directory / 'first[a].pdf', 2, 'First')
+	write_pdf(directory / 'second[b].pdf', 5, 'Second')
+	return directory
+
+
+def indexer(directory, database):
+	# a fresh catalog and indexer, as a restarted worker would have
+	catalog = site.DocumentCatalog(str(directory), 0)
+	catalog.refresh()
+	return site.DocumentIndexer(catalog, str(database))
+
+
+def rows(database):
+	with sqlite3.connect(str(database)) as connection:
+		return {row[0]: row[1:] for row in connection.execute("SELECT filename, pages, title FROM documents")}
+
+
+def test_metadata_survives_restart(directory, tmp_path, monkeypatch):
+	database = tmp_path / 'documents.sqlite3'
+	first = indexer(directory, database)
+	first.index()
+	assert first.catalog.info['first[a].pdf']['pages'] == 2
+	assert first.catalog.info['second[b].pdf']['title'] == 'Second'
+	# nothing is extracted again, the sidecar rows are installed as they are
+	monkeypatch.setattr(site, 'process_pool', None)
+	second = indexer(directory, database)
+	second.index()
+	assert second.catalog.info == first.catalog.info
+	digest = second.catalog.info['first[a].pdf']['sha256']
+	assert second.catalog.cached_digest('first[a].pdf') == digest
+	assert second.catalog.checksums[digest] == first.catalog.info['first[a].pdf']['crc32']
+
+
+def test_edited_document_is_extracted_again(directory, tmp_path):
+	database = tmp_path / 'documents.sqlite3'
+	indexer(directory, database).index()
+	write_pdf(directory / 'first[a].pdf', 7, 'First, revised')
+	edited = indexer(directory, database)
+	edited.index()
+	assert edited.catalog.info['first[a].pdf']['pages'] == 7
+	assert rows(database)['first[a].pdf'] == (7, 'First, revised')
+	assert rows(database)['second[b].pdf'] == (5, 'Second')
+
+
+def test_deleted_document_is_pruned(directory, tmp_path):
+	database = tmp_path / 'documents.sqlite3'
+	running = indexer(directory, database)
+	running.index()
+	(directory / 'second[b].pdf').unlink()
+	running.catalog.refresh()
+	running.index()
+	assert 'second[b].pdf' not in running.catalog.info
+	assert set(rows(database)) == {'first[a].pdf'}
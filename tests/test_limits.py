@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+import app as site
+
+
+@pytest.fixture
+def limiter(tmp_path):
+	# 1000 bytes of burst refilled at 100 bytes a second, one download at a time
+	return site.DownloadLimiter(str(tmp_path / 'limits.sqlite3'), 100, 1000, 1)
+
+
+def slots(limiter):
+	return limiter.connect().execute("SELECT COUNT(*) FROM slots").fetchone()[0]
+
+
+def test_acquire_and_release(limiter):
+	slot, wait = limiter.acquire('client', 10)
+	assert slot is not None and wait is None
+	assert limiter.acquire('client', 10) == (None, 5)
+	# other clients have their own slots
+	assert limiter.acquire('other', 10)[0] is not None
+	limiter.release(slot)
+	slot, wait = limiter.acquire('client', 10)
+	assert slot is not None and wait is None
+	limiter.release(slot)
+
+
+def test_length_is_charged_up_front(limiter):
+	slot, _ = limiter.acquire('client', 1500)
+	limiter.release(slot)
+	slot, wait = limiter.acquire('client', 10)
+	assert slot is None
+	# 500 bytes in debt at 100 bytes a second
+	assert 1 <= wait <= 5
+	assert slots(limiter) == 0
+
+
+def test_dead_workers_slots_are_reclaimed(limiter):
+	pid = os.fork()
+	if pid == 0:
+		os._exit(0)
+	os.waitpid(pid, 0)
+	limiter.connect().execute("INSERT INTO slots (client, pid) VALUES (?, ?)", ('client', pid))
+	slot, wait = limiter.acquire('client')
+	assert slot is not None and wait is None
+	assert slots(limiter) == 1
+
+
+def test_only_allowed_bodies_are_limited_and_counted(catalog, limiter, tmp_path, monkeypatch):
+	monkeypatch.setattr(site, 'download_limiter', limiter)
+	monkeypatch.setattr(site, 'counters', site.Counters(str(tmp_path / 'counters.sqlite3'), 3600))
+	monkeypatch.setattr(site.document_indexer, 'started', True)
+	monkeypatch.setitem(site.app.config, 'DOWNLOAD_LIMITS', True)
+	client = site.app.test_client()
+	filename = 'alpha[a].pdf'
+	url = f"/dochub/blob/{catalog.digest(filename)}/{filename}"
+	response = client.get(url)
+	etag = response.headers['ETag']
+	response.close()
+	assert response.status_code == 200
+	# the 10240 bytes leave the 1000 byte bucket in debt
+	assert client.get(url).status_code == 429
+	assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+	assert client.head(url).status_code == 200
+	assert site.counters.pending == {('download', filename): 1}
+	assert slots(limiter) == 0
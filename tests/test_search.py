@@ -0,0 +1,38 @@
+import pytest
+
+import app as site
+
+
+docs = [['first', 1, 3], ['second', 2, 5], ['third', 3, 200]]
+postings = {
+	'alpha': [(0, 1), (2, 300)],
+	'beta': [(1, 2)],
+	'betamax': [(0, 1), (1, 1), (2, 20000)],
+	'zéro': [(2, 1)],
+}
+
+
+def test_varints_round_trip():
+	numbers = [0, 1, 127, 128, 16383, 16384, 1 << 31]
+	assert list(site.decode_varints(site.encode_varints(numbers))) == numbers
+
+
+@pytest.mark.parametrize('segment_class', [site.SearchSegment, site.CompressedSegment])
+def test_segment_round_trip(tmp_path, segment_class):
+	filename = str(tmp_path / 'index' / 'search.idx')
+	segment_class.write(filename, docs, postings)
+	segment = segment_class(filename)
+	assert segment.docs == docs
+	assert [segment.term(i).decode() for i in range(segment.n_terms)] == sorted(postings)
+	for term, expected in postings.items():
+		(i,) = segment.find(term)
+		assert list(segment.postings_for(i)) == expected
+	assert [segment.term(i) for i in segment.find('beta', prefix=True)] == [b'beta', b'betamax']
+	assert not segment.find('gamma')
+
+
+def test_segment_rejects_other_format(tmp_path):
+	filename = str(tmp_path / 'search.idx')
+	site.SearchSegment.write(filename, docs, postings)
+	with pytest.raises(ValueError):
+		site.CompressedSegment(filename)